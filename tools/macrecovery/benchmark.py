@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark macrecovery offline against a local stand-in for osrecovery.apple.com.
+
+The stand-in hands out session cookies, answers RecoveryImage and Diagnostics queries
+following the server logic described in macrecovery's selfcheck, and serves synthetic
+images and chunklists signed with a throwaway test key. Latency, bandwidth, Range
+support, failure and stall rates are configurable, so download, verification and query
+paths can be timed in CI without network access.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import plistlib
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dmg
+import macrecovery
+
+SELF_DIR = os.path.dirname(os.path.realpath(__file__))
+
+# Apple ships recovery images in 10 MiB chunks
+CHUNK_SIZE = 10 * 2**20
+
+# Block runs of synthetic UDIF images, in bytes
+UDIF_RUN_SIZE = 2**20
+
+LATEST_PRODUCT = '071-00000'
+
+# Extra macrecovery options passed to every run, set from the command line
+MACRECOVERY_ARGS = []
+
+
+def is_probable_prime(value, rng, rounds=32):
+    for prime in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        if value % prime == 0:
+            return value == prime
+    d, s = value - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for _ in range(rounds):
+        x = pow(rng.randrange(2, value - 1), d, value)
+        if x in (1, value - 1):
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, value)
+            if x == value - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def generate_test_key(seed=0):
+    """
+    Generate a 2048-bit RSA key with the public exponent Apple uses, returning the
+    (modulus, private exponent) pair. Only ever meant for signing synthetic chunklists.
+    """
+    rng = random.Random(seed)
+    while True:
+        primes = []
+        while len(primes) < 2:
+            candidate = rng.getrandbits(1024) | (3 << 1022) | 1
+            if (candidate - 1) % 0x10001 != 0 and is_probable_prime(candidate, rng):
+                primes.append(candidate)
+        modulus = primes[0] * primes[1]
+        if modulus.bit_length() == 2048 and primes[0] != primes[1]:
+            return modulus, pow(0x10001, -1, (primes[0] - 1) * (primes[1] - 1))
+
+
+def make_chunklist(data, key, chunk_size=CHUNK_SIZE):
+    """
+    Build a signature_method 1 chunklist for data, signed with key from generate_test_key.
+    """
+    chunks = [data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size)]
+    header = macrecovery.ChunkListHeader.pack(b'CNKL', macrecovery.ChunkListHeader.size, 1, 1, 1, len(chunks),
+                                              0x24, 0x24 + macrecovery.Chunk.size * len(chunks))
+    body = header + b''.join(macrecovery.Chunk.pack(len(chunk), hashlib.sha256(chunk).digest()) for chunk in chunks)
+    digest = hashlib.sha256(body).digest()
+    plaintext = int(f'0x1{"f"*404}003031300d060960864801650304020105000420{"0"*64}', 16) | int.from_bytes(digest, 'big')
+    modulus, exponent = key
+    return body + pow(plaintext, exponent, modulus).to_bytes(256, 'little')
+
+
+def make_raw_disk(size, seed=0):
+    """
+    Generate a raw disk image of size bytes cycling through UDIF_RUN_SIZE regions of
+    incompressible data, compressible text with a zero hole in the middle, and zeros.
+    """
+    rng = random.Random(seed)
+    text = b''.join(f'sector {index:08d} of a synthetic disk\n'.encode() for index in range(UDIF_RUN_SIZE // 32))
+    hole = dmg.HOLE_SIZE * 2
+    regions = []
+    for index in range(0, size, UDIF_RUN_SIZE):
+        length = min(UDIF_RUN_SIZE, size - index)
+        kind = index // UDIF_RUN_SIZE % 3
+        if kind == 0:
+            regions.append(rng.randbytes(length))
+        elif kind == 1:
+            middle = length // 2 // dmg.HOLE_SIZE * dmg.HOLE_SIZE
+            regions.append((text[:middle] + bytes(hole) + text[middle + hole:])[:length])
+        else:
+            regions.append(bytes(length))
+    return b''.join(regions)
+
+
+def make_udif(raw):
+    """
+    Wrap raw, a whole number of sectors, into a UDIF image with one blkx table whose
+    UDIF_RUN_SIZE block runs are zero runs for zeros, zlib runs where zlib saves space
+    and raw runs otherwise.
+    """
+    assert len(raw) % dmg.SECTOR_SIZE == 0
+    data, entries = [], []
+    offset = 0
+    for start in range(0, len(raw), UDIF_RUN_SIZE):
+        block = raw[start:start + UDIF_RUN_SIZE]
+        sector, sectors = start // dmg.SECTOR_SIZE, len(block) // dmg.SECTOR_SIZE
+        if block.count(0) == len(block):
+            entries.append(dmg.BlockRun.pack(dmg.RUN_ZERO, 0, sector, sectors, offset, 0))
+            continue
+        compressed = zlib.compress(block, 1)
+        kind, payload = (dmg.RUN_ZLIB, compressed) if len(compressed) < len(block) else (dmg.RUN_RAW, block)
+        entries.append(dmg.BlockRun.pack(kind, 0, sector, sectors, offset, len(payload)))
+        data.append(payload)
+        offset += len(payload)
+    entries.append(dmg.BlockRun.pack(dmg.RUN_END, 0, len(raw) // dmg.SECTOR_SIZE, 0, offset, 0))
+
+    sectors = len(raw) // dmg.SECTOR_SIZE
+    mish = dmg.MishHeader.pack(b'mish', 1, 0, sectors, 0, 0, 0, bytes(24), 0, 0, bytes(128), len(entries))
+    plist = plistlib.dumps({'resource-fork': {'blkx': [{'Name': 'synthetic (Apple_HFS : 1)', 'Data': mish + b''.join(entries)}]}})
+    koly = dmg.KolyHeader.pack(b'koly', 4, dmg.KolyHeader.size, 1, 0, 0, offset, 0, 0, 1, 1, bytes(16), 0, 0, bytes(128),
+                               offset, len(plist), bytes(120), 0, 0, bytes(128), 1, sectors, bytes(12))
+    return b''.join(data) + plist + koly
+
+
+def make_image(size, seed=0):
+    """
+    Generate size bytes of incompressible image data.
+    """
+    return random.Random(seed).randbytes(size)
+
+
+class StandIn:
+    """
+    Local osrecovery.apple.com replacement serving one synthetic image for every product.
+    Each MLB EEEE code is owned by one board, taken from owners or else picked by hash.
+    """
+
+    def __init__(self, image, chunklist, boards, latency=0.0, bandwidth=0, ranges=True, fail_rate=0.0, query_fail_rate=0.0,
+                 stall_rate=0.0, stall_time=60.0, seed=0, owners=None):
+        self.image = image
+        self.chunklist = chunklist
+        self.boards = boards
+        self.owners = {macrecovery.MLB_VALID[11:15]: macrecovery.RECENT_MAC} if owners is None else owners
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.fail_rate = fail_rate
+        self.query_fail_rate = query_fail_rate
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.stalls = 0
+        self.sent = 0
+        self.queries = 0
+
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_GET(self):
+                outer.handle(self, None)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                outer.handle(self, body.decode())
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        # Clients hang up on purpose (aborted segments, injected failures), so stay quiet about it.
+        self.httpd.handle_error = lambda request, address: None
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def should_fail(self, rate):
+        with self.lock:
+            self.requests += 1
+            if rate > 0 and self.rng.random() < rate:
+                self.failures += 1
+                return True
+        return False
+
+    def should_stall(self):
+        with self.lock:
+            if self.stall_rate > 0 and self.rng.random() < self.stall_rate:
+                self.stalls += 1
+                return True
+        return False
+
+    def product(self, bid, mlb, os_type, diag):
+        """
+        Pick a product following the server logic documented in action_selfcheck.
+        """
+        if diag:
+            return '071-DIAGS'
+        if bid not in self.boards and bid != macrecovery.RECENT_MAC:
+            return None
+        version = self.boards.get(bid, 'latest')
+        board_latest = LATEST_PRODUCT if version == 'latest' else f'071-{version}'
+        if mlb[11:15] == '0000':
+            return board_latest
+        # Only the owning board has an older default product for the MLB.
+        digest = hashlib.sha256(mlb[11:15].encode()).hexdigest()
+        owner = self.owners.get(mlb[11:15]) or sorted(self.boards)[int(digest, 16) % len(self.boards)]
+        if bid != owner:
+            return board_latest
+        # Product-only MLBs zero out everything but the EEEE code, and always get the oldest.
+        if mlb[3:11] != '0' * 8 and os_type == 'latest':
+            return board_latest
+        return f'041-{digest[:5].upper()}'
+
+    def handle(self, request, post):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        path = request.path.split('?')[0]
+
+        if path == '/' and post is None:
+            if self.should_fail(self.query_fail_rate):
+                return self.respond(request, 503, b'')
+            if self.should_stall():
+                time.sleep(self.stall_time)
+            return self.respond(request, 200, b'', {'Set-Cookie': f'session={random.getrandbits(64):016x}; Path=/'})
+
+        if path in ('/InstallationPayload/RecoveryImage', '/InstallationPayload/Diagnostics') and post is not None:
+            if self.should_fail(self.query_fail_rate):
+                return self.respond(request, 503, b'')
+            if self.should_stall():
+                time.sleep(self.stall_time)
+            with self.lock:
+                self.queries += 1
+            fields = dict(line.split('=', 1) for line in post.split('\n') if '=' in line)
+            product = self.product(fields.get('bid', ''), fields.get('sn', ''), fields.get('os', 'default'), path.endswith('Diagnostics'))
+            if product is None:
+                return self.respond(request, 404, b'')
+            lines = [
+                f'{macrecovery.INFO_PRODUCT}: {product}',
+                f'{macrecovery.INFO_IMAGE_LINK}: {self.url}/{product}/BaseSystem.dmg',
+                f'{macrecovery.INFO_IMAGE_HASH}: {hashlib.sha256(self.chunklist).hexdigest()}',
+                f'{macrecovery.INFO_IMAGE_SESS}: expires=0~access=/{product}/*~md5=0',
+                f'{macrecovery.INFO_SIGN_LINK}: {self.url}/{product}/BaseSystem.chunklist',
+                f'{macrecovery.INFO_SIGN_HASH}: {hashlib.sha256(self.chunklist).hexdigest()}',
+                f'{macrecovery.INFO_SIGN_SESS}: expires=0~access=/{product}/*~md5=0',
+            ]
+            return self.respond(request, 200, '\n'.join(lines).encode(), {'Content-Type': 'text/plain'})
+
+        if path.endswith('/BaseSystem.chunklist'):
+            self.should_fail(0)
+            return self.respond(request, 200, self.chunklist)
+        if path.endswith('/BaseSystem.dmg'):
+            return self.serve_image(request, self.should_fail(self.fail_rate))
+        return self.respond(request, 404, b'')
+
+    def respond(self, request, status, body, headers=None):
+        request.send_response(status)
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def serve_image(self, request, failing):
+        start, end = 0, len(self.image)
+        crange = request.headers.get('Range')
+        if crange is not None and self.ranges:
+            first, _, last = crange.split('=', 1)[1].partition('-')
+            start = int(first)
+            end = min(int(last) + 1, len(self.image)) if last else len(self.image)
+            request.send_response(206)
+            request.send_header('Content-Range', f'bytes {start}-{end - 1}/{len(self.image)}')
+        else:
+            request.send_response(200)
+        request.send_header('Content-Length', str(end - start))
+        request.end_headers()
+
+        # Failing transfers are cut off at a random point in the body, stalling ones pause there.
+        cutoff = end if not failing else start + self.rng.randrange(end - start)
+        stall = start + self.rng.randrange(end - start) if self.should_stall() else None
+        sent = 0
+        began = time.monotonic()
+        offset = start
+        while offset < cutoff:
+            if stall is not None and offset >= stall:
+                time.sleep(self.stall_time)
+                stall = None
+            count = min(256 * 2**10, cutoff - offset)
+            request.wfile.write(self.image[offset:offset + count])
+            offset += count
+            sent += count
+            with self.lock:
+                self.sent += count
+            if self.bandwidth > 0:
+                delay = sent / self.bandwidth - (time.monotonic() - began)
+                if delay > 0:
+                    time.sleep(delay)
+        if failing:
+            request.close_connection = True
+            request.connection.shutdown(socket.SHUT_RDWR)
+
+
+def run(argv, cache=False):
+    """
+    Run macrecovery in-process with argv, returning the exit code and captured output.
+    Unless cache is set the image info cache is off, so results never leak into the
+    user's cache; callers enabling it pass their own --cache-dir.
+    """
+    sys.argv = ['macrecovery.py'] + ([] if cache else ['--no-cache']) + MACRECOVERY_ARGS + argv
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            result = macrecovery.main()
+        except SystemExit as err:
+            result = err.code
+    return result or 0, output.getvalue()
+
+
+def run_download(argv, attempts):
+    """
+    Run download with argv up to attempts times like setup does, resuming from the
+    verified chunks, and return the exit code, all output and the attempts made.
+    """
+    outputs = []
+    for attempt in range(1, attempts + 1):
+        result, output = run(['download', '--resume'] + argv)
+        outputs.append(output)
+        if result == 0:
+            break
+    return result, ''.join(outputs), attempt
+
+
+def bench_download(workdir, size, connections, attempts):
+    outdir = os.path.join(workdir, f'download-{connections}')
+    shutil.rmtree(outdir, ignore_errors=True)
+    start = time.monotonic()
+    result, _, attempt = run_download(['-o', outdir, '-c', str(connections)], attempts)
+    seconds = time.monotonic() - start
+    return {'name': f'download -c {connections}', 'status': result, 'seconds': seconds,
+            'mb_per_second': size / 2**20 / seconds, 'attempts': attempt}, outdir
+
+
+def bench_verify(outdir, size, jobs):
+    start = time.monotonic()
+    result, _ = run(['download', '--verify-only', '--force', '-o', outdir, '-j', str(jobs)])
+    seconds = time.monotonic() - start
+    return {'name': f'verify -j {jobs}', 'status': result, 'seconds': seconds, 'mb_per_second': size / 2**20 / seconds}
+
+
+def bench_delta(workdir, standin, key, chunk_size, seed, attempts):
+    """
+    Download an image into a fresh --store, then an overlapping one whose second chunk
+    differs, which must be assembled from the stored chunks plus the missing ranges.
+    Images of a single chunk share nothing, so None is returned for them.
+    """
+    image = standin.image
+    if len(image) <= chunk_size:
+        return None
+    changed = make_image(min(chunk_size, len(image) - chunk_size), seed + 1)
+    offset = chunk_size
+    delta = image[:offset] + changed + image[offset + len(changed):]
+    stored = {hashlib.sha256(image[i:i + chunk_size]).digest() for i in range(0, len(image), chunk_size)}
+    expected = sum(len(delta[i:i + chunk_size]) for i in range(0, len(delta), chunk_size)
+                   if hashlib.sha256(delta[i:i + chunk_size]).digest() not in stored)
+
+    options = ['--store', '--cache-dir', os.path.join(workdir, 'delta-cache'), '-o']
+    result, _, _ = run_download(options + [os.path.join(workdir, 'delta-base')], attempts)
+    if result != 0:
+        return {'name': 'download delta', 'status': result, 'seconds': 0.0, 'mb_per_second': 0.0, 'fetched': 0, 'expected': expected}
+    original = standin.image, standin.chunklist
+    standin.image, standin.chunklist = delta, make_chunklist(delta, key, chunk_size)
+    try:
+        start = time.monotonic()
+        sent, failures, stalls = standin.sent, standin.failures, standin.stalls
+        result, output, _ = run_download(options + [os.path.join(workdir, 'delta')], attempts)
+        seconds = time.monotonic() - start
+        fetched = standin.sent - sent
+        injected = standin.failures != failures or standin.stalls != stalls
+    finally:
+        standin.image, standin.chunklist = original
+    # Injected failures and stalls make ranges be fetched again, otherwise only changed chunks may be.
+    if result == 0 and ('reusing stored chunks' not in output or not injected and fetched != expected):
+        result = 'mismatch'
+    return {'name': 'download delta', 'status': result, 'seconds': seconds, 'mb_per_second': len(delta) / 2**20 / seconds,
+            'fetched': fetched, 'expected': expected}
+
+
+def bench_dmg(workdir, size, jobs, seed):
+    """
+    Convert a synthetic UDIF image with dmg.convert, checking that the raw output matches
+    the original disk and that only its non-zero HOLE_SIZE blocks were written.
+    """
+    raw = make_raw_disk(size, seed)
+    source = os.path.join(workdir, 'synthetic.dmg')
+    target = os.path.join(workdir, f'synthetic-{jobs}.img')
+    with open(source, 'wb') as fh:
+        fh.write(make_udif(raw))
+    expected = sum(end - start for start, end in dmg.data_spans(raw))
+
+    start = time.monotonic()
+    try:
+        converted, written = dmg.convert(source, target, jobs)
+        status = 0
+    except RuntimeError as err:
+        converted, written, status = 0, 0, str(err)
+    seconds = time.monotonic() - start
+    if status == 0:
+        with open(target, 'rb') as fh:
+            if converted != len(raw) or written != expected or fh.read() != raw:
+                status = 'mismatch'
+    os.remove(target)
+    return {'name': f'dmg convert -j {jobs}', 'status': status, 'seconds': seconds, 'mb_per_second': size / 2**20 / seconds,
+            'written': written}
+
+
+def bench_chunklist(key, entries, seed):
+    """
+    Time parsing a chunklist of entries 64-byte chunks, looking up the chunks covering
+    random 4 KiB ranges, and verifying every chunk of the image through verify_range.
+    """
+    image = make_image(entries * 64, seed)
+    data = make_chunklist(image, key, 64)
+    rng = random.Random(seed)
+    offsets = [rng.randrange(len(image)) for _ in range(entries)]
+    results = []
+
+    start = time.monotonic()
+    chunks = macrecovery.ChunkList(data)
+    seconds = time.monotonic() - start
+    status = 0 if len(chunks) == entries and chunks.total_size == len(image) else 'mismatch'
+    results.append({'name': 'chunklist parse', 'status': status, 'seconds': seconds, 'ops_per_second': entries / seconds})
+
+    start = time.monotonic()
+    covered = sum(len(chunks.chunks_covering(offset, 4096)) for offset in offsets)
+    seconds = time.monotonic() - start
+    # Unaligned 4 KiB ranges span 64 or 65 chunks, fewer at the end of the image.
+    status = 0 if 0 < covered <= 65 * entries else 'mismatch'
+    results.append({'name': 'chunklist lookup', 'status': status, 'seconds': seconds, 'ops_per_second': entries / seconds})
+
+    start = time.monotonic()
+    try:
+        status = 0 if chunks.verify_range(io.BytesIO(image), 0, len(image)) == range(entries) else 'mismatch'
+    except macrecovery.VerificationError:
+        status = 'mismatch'
+    seconds = time.monotonic() - start
+    results.append({'name': 'chunklist verify', 'status': status, 'seconds': seconds, 'ops_per_second': entries / seconds})
+    return results
+
+
+def bench_cache(workdir, standin, boards):
+    """
+    Run guess over a few boards against a fresh --cache-dir, counting the image info
+    queries reaching the stand-in: a cold run asks for every entry, a warm run for none,
+    --refresh, --cache-ttl 0 and --no-cache for all again, and a run after --cache-size 1
+    evicted all but one entry for all of the others.
+    """
+    board_db = os.path.join(workdir, 'cache-boards.json')
+    with open(board_db, 'w', encoding='utf-8') as fh:
+        json.dump(dict(list(boards.items())[:3]), fh)
+    # Hedged duplicates would be counted as misses.
+    guess = ['guess', '-m', macrecovery.MLB_VALID, '-db', board_db, '--hedge-delay', '0',
+             '--cache-dir', os.path.join(workdir, 'cache')]
+    # Every board is asked for its latest and default product, besides the generic latest one.
+    entries = 1 + 2 * min(len(boards), 3)
+    expected = {'cold': entries, 'warm': 0, 'refresh': entries, 'expired': entries, 'disabled': entries,
+                'evicting': entries, 'evicted': entries - 1}
+    options = {'cold': [], 'warm': [], 'refresh': ['--refresh'], 'expired': ['--cache-ttl', '0'],
+               'disabled': ['--no-cache'], 'evicting': ['--refresh', '--cache-size', '1'], 'evicted': []}
+
+    start = time.monotonic()
+    failures, stalls = standin.failures, standin.stalls
+    result, queries = 0, {}
+    for name, extra in options.items():
+        count = standin.queries
+        result, _ = run(guess + extra, cache=True)
+        queries[name] = standin.queries - count
+        if result != 0:
+            break
+    # Injected query failures and stalls are retried, which makes the counts larger.
+    if result == 0 and standin.failures == failures and standin.stalls == stalls and queries != expected:
+        result = 'mismatch'
+    return {'name': 'guess cache', 'status': result, 'seconds': time.monotonic() - start,
+            'requests': sum(queries.values()), 'queries': queries}
+
+
+def bench_action(name, argv, standin):
+    start = time.monotonic()
+    requests = standin.requests
+    result, output = run(argv)
+    return {'name': name, 'status': result, 'seconds': time.monotonic() - start,
+            'requests': standin.requests - requests, 'output': output}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark macrecovery against a local osrecovery stand-in')
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='synthetic image size in MiB, defaults to 256')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help=f'chunklist chunk size in bytes, defaults to {CHUNK_SIZE}')
+    parser.add_argument('-c', '--connections', type=int, nargs='+', default=[1, 4],
+                        help='connection counts to benchmark downloads with, defaults to 1 4')
+    parser.add_argument('-j', '--jobs', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}),
+                        help='job counts to benchmark verification with, defaults to 1 and the CPU count')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='delay every response by the specified number of milliseconds')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='limit every image response to the specified number of MiB per second')
+    parser.add_argument('--no-ranges', action='store_true', help='ignore Range requests like some mirrors do')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='fraction of image transfers cut off at a random point')
+    parser.add_argument('--query-fail-rate', type=float, default=0.0,
+                        help='fraction of session and image info queries failing with 503')
+    parser.add_argument('--stall-rate', type=float, default=0.0,
+                        help='fraction of image transfers and queries pausing for --stall-time seconds, combine with --read-timeout')
+    parser.add_argument('--stall-time', type=float, default=60.0,
+                        help='length of injected stalls in seconds, defaults to 60')
+    parser.add_argument('--read-timeout', type=float, default=None,
+                        help='pass the specified --read-timeout to macrecovery')
+    parser.add_argument('--hedge-delay', type=float, default=None,
+                        help='pass the specified --hedge-delay to macrecovery')
+    parser.add_argument('--attempts', type=int, default=3,
+                        help='download attempts, resuming after failures, defaults to 3')
+    parser.add_argument('--board-db', type=str, default=os.path.join(SELF_DIR, 'boards.json'),
+                        help='board database used for the guess benchmark')
+    parser.add_argument('--chunklist-entries', type=int, default=100000,
+                        help='chunks in the chunklist microbenchmark, defaults to 100000')
+    parser.add_argument('--seed', type=int, default=0, help='seed for synthetic data and failures')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    with open(args.board_db, 'r', encoding='utf-8') as fh:
+        boards = json.load(fh)
+
+    size = args.size * 2**20
+    key = generate_test_key(args.seed)
+    image = make_image(size, args.seed)
+    chunklist = make_chunklist(image, key, args.chunk_size)
+
+    # MLBs owned by the last board of a tier, whose answer no other board of the tier shares.
+    mlb_tier = macrecovery.MLB_VALID[:11] + 'T127' + macrecovery.MLB_VALID[15:]
+    mlb_last = macrecovery.MLB_VALID[:11] + 'TLST' + macrecovery.MLB_VALID[15:]
+    owners = {macrecovery.MLB_VALID[11:15]: macrecovery.RECENT_MAC, 'T127': 'Mac-B809C3757DA9BB8D', 'TLST': 'Mac-7BA5B2D9E42DDD94'}
+
+    macrecovery.Apple_EFI_ROM_public_key_1 = key[0]
+    standin = StandIn(image, chunklist, boards, args.latency / 1000, args.bandwidth * 2**20, not args.no_ranges,
+                      args.fail_rate, args.query_fail_rate, args.stall_rate, args.stall_time, args.seed, owners)
+    macrecovery.RECOVERY_SERVER = standin.url
+    for option in ('read_timeout', 'hedge_delay'):
+        if getattr(args, option) is not None:
+            MACRECOVERY_ARGS.extend([f'--{option.replace("_", "-")}', str(getattr(args, option))])
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix='macrecovery-bench-')
+    try:
+        outdir = None
+        for connections in args.connections:
+            result, outdir = bench_download(workdir, size, connections, args.attempts)
+            results.append(result)
+        if outdir is not None:
+            for jobs in args.jobs:
+                results.append(bench_verify(outdir, size, jobs))
+        delta = bench_delta(workdir, standin, key, args.chunk_size, args.seed, args.attempts)
+        if delta is not None:
+            results.append(delta)
+        results.append(bench_cache(workdir, standin, boards))
+        results.extend(bench_chunklist(key, args.chunklist_entries, args.seed))
+        for jobs in args.jobs:
+            results.append(bench_dmg(workdir, size, jobs, args.seed))
+        results.append(bench_action('selfcheck', ['selfcheck'], standin))
+        for kind, mlb in (('valid', macrecovery.MLB_VALID), ('anon', macrecovery.product_mlb(macrecovery.MLB_VALID)),
+                          ('tier', mlb_tier), ('anon last', macrecovery.product_mlb(mlb_last))):
+            exhaustive = bench_action(f'guess {kind} all', ['guess', '-m', mlb, '-db', args.board_db, '--exhaustive'], standin)
+            pruned = bench_action(f'guess {kind}', ['guess', '-m', mlb, '-db', args.board_db], standin)
+            # The pruned search must report exactly what probing every board does.
+            if pruned['status'] == 0 and pruned['output'] != exhaustive['output']:
+                pruned['status'] = 'mismatch'
+            results.extend([exhaustive, pruned])
+    finally:
+        standin.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for result in results:
+        result.pop('output', None)
+    if args.json:
+        print(json.dumps({'size': size, 'requests': standin.requests, 'failures': standin.failures, 'stalls': standin.stalls,
+                          'results': results}, indent=1))
+    else:
+        for result in results:
+            if 'mb_per_second' in result:
+                rate = f'{result["mb_per_second"]:8.1f} MB/s'
+            elif 'ops_per_second' in result:
+                rate = f'{result["ops_per_second"]:8.0f} op/s'
+            else:
+                rate = f'{result["requests"]:4d} requests'
+            status = 'ok' if result['status'] == 0 else f'FAILED ({result["status"]})'
+            print(f'{result["name"]:<20} {result["seconds"]:8.3f} s {rate}  {status}')
+        print(f'{standin.requests} requests served, {standin.failures} failures and {standin.stalls} stalls injected')
+
+    return 0 if all(result['status'] == 0 for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
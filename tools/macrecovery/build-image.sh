@@ -14,5 +14,5 @@ diskutil umount disk"${N}"s1
 hdiutil detach "$newDevice"
 hdiutil convert -format UDZO Recovery.dmg.sparseimage -o Recovery.RO.dmg
 rm Recovery.dmg.sparseimage
-qemu-img convert -f dmg -O raw Recovery.RO.dmg Recovery.raw
+python3 "$(dirname "$0")/dmg.py" Recovery.RO.dmg Recovery.raw
 rm Recovery.RO.dmg
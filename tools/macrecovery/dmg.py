@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+Convert UDIF (DMG) images to raw disk images.
+
+Every block run listed in the mish tables is independent, so runs are decompressed on a
+process pool and written straight to their place in the output. Zero and free runs are
+left as holes, which keeps the raw output sparse.
+"""
+
+import argparse
+import bz2
+import concurrent.futures
+import lzma
+import os
+import plistlib
+import struct
+import sys
+import zlib
+
+SECTOR_SIZE = 512
+
+KolyHeader = struct.Struct('>4sIIIQQQQQII16sII128sQQ120sII128sIQ12s')
+assert KolyHeader.size == 512
+
+MishHeader = struct.Struct('>4sIQQQII24sII128sI')
+assert MishHeader.size == 204
+
+BlockRun = struct.Struct('>IIQQQQ')
+assert BlockRun.size == 40
+
+RUN_ZERO = 0x00000000
+RUN_RAW = 0x00000001
+RUN_FREE = 0x00000002
+RUN_ADC = 0x80000004
+RUN_ZLIB = 0x80000005
+RUN_BZIP2 = 0x80000006
+RUN_LZFSE = 0x80000007
+RUN_LZMA = 0x80000008
+RUN_COMMENT = 0x7FFFFFFE
+RUN_END = 0xFFFFFFFF
+
+DECOMPRESSORS = {
+    RUN_RAW: bytes,
+    RUN_ZLIB: zlib.decompress,
+    RUN_BZIP2: bz2.decompress,
+    RUN_LZMA: lzma.decompress,
+}
+
+RUN_NAMES = {RUN_ADC: 'ADC', RUN_LZFSE: 'LZFSE'}
+
+# Decompression jobs are batched to roughly this many compressed bytes to keep
+# the process pool overhead small next to the actual work.
+BATCH_SIZE = 16 * 2**20
+
+# Zero spans at least this large inside decompressed data are left as holes too.
+HOLE_SIZE = 64 * 2**10
+
+
+def read_koly(fh):
+    """
+    Read the UDIF trailer and return its fields as a dict.
+    """
+    fh.seek(0, os.SEEK_END)
+    if fh.tell() < KolyHeader.size:
+        raise RuntimeError('File is too small to be a DMG')
+    fh.seek(-KolyHeader.size, os.SEEK_END)
+    fields = KolyHeader.unpack(fh.read(KolyHeader.size))
+    if fields[0] != b'koly':
+        raise RuntimeError('Missing koly trailer, not a UDIF image')
+    return {
+        'version': fields[1],
+        'data_offset': fields[5],
+        'data_length': fields[6],
+        'xml_offset': fields[15],
+        'xml_length': fields[16],
+        'sector_count': fields[22],
+    }
+
+
+def read_runs(fh, koly):
+    """
+    Parse the blkx tables from the XML property list and return the list of block runs
+    as (type, output offset, output length, input offset, input length) tuples.
+    """
+    if koly['xml_length'] == 0:
+        raise RuntimeError('DMG has no XML property list')
+    fh.seek(koly['xml_offset'])
+    plist = plistlib.loads(fh.read(koly['xml_length']))
+    try:
+        tables = plist['resource-fork']['blkx']
+    except KeyError:
+        raise RuntimeError('DMG property list has no blkx tables') from None
+
+    runs = []
+    for table in tables:
+        data = table['Data']
+        fields = MishHeader.unpack_from(data)
+        if fields[0] != b'mish':
+            raise RuntimeError(f'Invalid blkx table {table.get("Name", "")}')
+        first_sector, data_offset, count = fields[2], fields[4], fields[11]
+        for entry in BlockRun.iter_unpack(data[MishHeader.size:MishHeader.size + count * BlockRun.size]):
+            kind, _, sector, sectors, offset, length = entry
+            if kind in (RUN_COMMENT, RUN_END):
+                continue
+            if kind in RUN_NAMES:
+                raise RuntimeError(f'{RUN_NAMES[kind]} compressed DMG images are not supported')
+            if kind not in DECOMPRESSORS and kind not in (RUN_ZERO, RUN_FREE):
+                raise RuntimeError(f'Unknown DMG block type {kind:#010x}')
+            runs.append((kind, (first_sector + sector) * SECTOR_SIZE, sectors * SECTOR_SIZE,
+                         koly['data_offset'] + data_offset + offset, length))
+    return runs
+
+
+def batch_runs(runs):
+    """
+    Group the runs holding data into batches of about BATCH_SIZE compressed bytes.
+    """
+    batch, size = [], 0
+    for run in runs:
+        if run[0] in (RUN_ZERO, RUN_FREE) or run[2] == 0:
+            continue
+        batch.append(run)
+        size += run[4]
+        if size >= BATCH_SIZE:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def data_spans(data):
+    """
+    Yield (start, end) spans of data that are not made of HOLE_SIZE aligned zero blocks.
+    """
+    view = memoryview(data)
+    zero = bytes(HOLE_SIZE)
+    start = None
+    for offset in range(0, len(data), HOLE_SIZE):
+        block = view[offset:offset + HOLE_SIZE]
+        if block == zero[:len(block)]:
+            if start is not None:
+                yield start, offset
+                start = None
+        elif start is None:
+            start = offset
+    if start is not None:
+        yield start, len(data)
+
+
+def convert_batch(source, target, batch):
+    """
+    Decompress a batch of runs from source into target. Zero blocks are skipped so they
+    stay holes. Returns the number of bytes written.
+    """
+    written = 0
+    with open(source, 'rb') as src, open(target, 'r+b') as dst:
+        for kind, out_offset, out_length, in_offset, in_length in batch:
+            data = DECOMPRESSORS[kind](os.pread(src.fileno(), in_length, in_offset))
+            if len(data) != out_length:
+                raise RuntimeError(f'Block at {in_offset} decompressed to {len(data)} bytes, expected {out_length}')
+            view = memoryview(data)
+            for start, end in data_spans(data):
+                os.pwrite(dst.fileno(), view[start:end], out_offset + start)
+                written += end - start
+    return written
+
+
+def convert(source, target, jobs=1):
+    """
+    Convert the DMG at source into a sparse raw image at target using jobs processes.
+    Returns the (raw size, bytes written) tuple.
+    """
+    with open(source, 'rb') as fh:
+        koly = read_koly(fh)
+        runs = read_runs(fh, koly)
+
+    size = max([koly['sector_count'] * SECTOR_SIZE] + [run[1] + run[2] for run in runs])
+    with open(target, 'wb') as fh:
+        fh.truncate(size)
+
+    written = 0
+    if jobs == 1:
+        for batch in batch_runs(runs):
+            written += convert_batch(source, target, batch)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(convert_batch, source, target, batch) for batch in batch_runs(runs)]
+            for future in futures:
+                written += future.result()
+    return size, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert UDIF (DMG) images to sparse raw disk images')
+    parser.add_argument('source', help='DMG image to convert')
+    parser.add_argument('target', help='raw image to create')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='decompress with the specified number of processes, defaults to the CPU count')
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        print('ERROR: Jobs must be at least 1')
+        return 1
+
+    try:
+        size, written = convert(args.source, args.target, args.jobs)
+    except (OSError, RuntimeError, ValueError, zlib.error, lzma.LZMAError) as err:
+        print(f'ERROR: {err}')
+        return 1
+
+    print(f'Converted {args.source} to {args.target}: {size} bytes, {written} bytes of data')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
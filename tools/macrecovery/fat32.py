@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+"""
+Build FAT32 raw disk images without mounting them.
+
+The whole layout is computed from the final file sizes before any data is written, so
+every file gets a contiguous, preallocated cluster run and its bytes can be written
+straight into the image while they are still downloading.
+"""
+
+import array
+import struct
+import time
+
+SECTOR_SIZE = 512
+RESERVED_SECTORS = 32
+NUM_FATS = 2
+ROOT_CLUSTER = 2
+FSINFO_SECTOR = 1
+BACKUP_BOOT_SECTOR = 6
+
+# FAT32 needs at least this many clusters to be recognised as FAT32
+MIN_CLUSTERS = 65525
+END_OF_CHAIN = 0x0FFFFFFF
+
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LONG_NAME = 0x0F
+
+BootSector = struct.Struct('<3s8sHBHBHHBHHHIIIHHIHH12sBBBI11s8s')
+assert BootSector.size == 90
+
+DirEntry = struct.Struct('<11sBBBHHHHHHHI')
+assert DirEntry.size == 32
+
+LongNameEntry = struct.Struct('<B10sBBB12sH4s')
+assert LongNameEntry.size == 32
+
+SHORT_NAME_CHARS = set('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789$%\'-_@~`!(){}^#&')
+
+
+def parse_size(value):
+    """
+    Parse a fallocate style size such as 800M or 1450M into bytes.
+    """
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    value = value.strip().upper()
+    if value.endswith('IB'):
+        value = value[:-2]
+    elif value.endswith('B'):
+        value = value[:-1]
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+
+def sectors_per_cluster(total_sectors):
+    # Cluster sizes follow the FAT32 defaults from the Microsoft FAT specification.
+    for limit, sectors in ((532480, 1), (16777216, 8), (33554432, 16), (67108864, 32)):
+        if total_sectors <= limit:
+            return sectors
+    return 64
+
+
+def dos_datetime(timestamp):
+    tm = time.localtime(timestamp)
+    date = ((max(tm.tm_year, 1980) - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday
+    dostime = (tm.tm_hour << 11) | (tm.tm_min << 5) | (min(tm.tm_sec, 59) // 2)
+    return date, dostime
+
+
+def short_name_checksum(name):
+    checksum = 0
+    for char in name:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + char) & 0xFF
+    return checksum
+
+
+def short_name(name, taken):
+    """
+    Generate a unique 8.3 name for name. Returns the 11 byte name and whether a long
+    name entry is needed to preserve the original.
+    """
+    if name in ('.', '..'):
+        return name.encode().ljust(11), False
+
+    base, dot, ext = name.rpartition('.')
+    if not dot:
+        base, ext = name, ''
+
+    def clean(part):
+        return ''.join(char if char in SHORT_NAME_CHARS else '_' for char in part.upper().replace(' ', '').replace('.', ''))
+
+    sbase, sext = clean(base), clean(ext)[:3]
+    if name == name.upper() and len(base) <= 8 and len(ext) <= 3 and sbase == base.upper() and sext == ext.upper() and base:
+        candidate = sbase.ljust(8).encode() + sext.ljust(3).encode()
+        if candidate not in taken:
+            return candidate, False
+
+    for index in range(1, 1000000):
+        tail = f'~{index}'
+        candidate = (sbase[:8 - len(tail)] + tail).ljust(8).encode() + sext.ljust(3).encode()
+        if candidate not in taken:
+            return candidate, True
+
+    raise RuntimeError(f'Cannot generate short name for {name}')
+
+
+def long_name_entries(name, checksum):
+    encoded = name.encode('utf-16-le') + b'\0\0'
+    if len(encoded) % 26:
+        encoded += b'\xff' * (26 - len(encoded) % 26)
+    count = len(encoded) // 26
+    entries = []
+    for index in range(count):
+        part = encoded[index * 26:(index + 1) * 26]
+        order = index + 1
+        if order == count:
+            order |= 0x40
+        entries.append(LongNameEntry.pack(order, part[:10], ATTR_LONG_NAME, 0, checksum, part[10:22], 0, part[22:26]))
+    # Long name entries precede the short entry in reverse order.
+    return entries[::-1]
+
+
+class Node:
+    """
+    File or directory placed in the image.
+    """
+
+    def __init__(self, name, size=0, directory=False):
+        self.name = name
+        self.size = size
+        self.directory = directory
+        self.children = []
+        self.cluster = 0
+        self.clusters = 0
+        self.offset = None
+
+    def child(self, name):
+        for node in self.children:
+            if node.name == name:
+                return node
+        return None
+
+
+class Fat32Image:
+    """
+    FAT32 superfloppy image (no partition table), as created by mkfs.msdos on a raw file.
+    Add every file with add_file, then call write to lay down the file system metadata;
+    each returned node's offset tells where its data belongs in the image.
+    """
+
+    def __init__(self, size, label='NO NAME', timestamp=None):
+        self.total_sectors = size // SECTOR_SIZE
+        self.size = self.total_sectors * SECTOR_SIZE
+        self.label = label.upper()[:11]
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.sectors_per_cluster = sectors_per_cluster(self.total_sectors)
+        self.cluster_size = self.sectors_per_cluster * SECTOR_SIZE
+
+        # FAT size calculation from the Microsoft FAT specification.
+        tmp1 = self.total_sectors - RESERVED_SECTORS
+        tmp2 = (256 * self.sectors_per_cluster + NUM_FATS) // 2
+        self.fat_sectors = (tmp1 + tmp2 - 1) // tmp2
+        self.data_sector = RESERVED_SECTORS + NUM_FATS * self.fat_sectors
+        self.cluster_count = (self.total_sectors - self.data_sector) // self.sectors_per_cluster
+        if self.cluster_count < MIN_CLUSTERS:
+            raise RuntimeError(f'Image size {size} is too small for FAT32')
+
+        self.root = Node('', directory=True)
+        self.next_cluster = None
+
+    def add_file(self, path, size):
+        """
+        Add a file of size bytes at path, creating parent directories as needed.
+        """
+        parts = [part for part in path.replace('\\', '/').split('/') if part not in ('', '.')]
+        if not parts or '..' in parts:
+            raise RuntimeError(f'Invalid image path {path}')
+        parent = self.root
+        for part in parts[:-1]:
+            node = parent.child(part)
+            if node is None:
+                node = Node(part, directory=True)
+                parent.children.append(node)
+            elif not node.directory:
+                raise RuntimeError(f'{part} in {path} is not a directory')
+            parent = node
+        if parent.child(parts[-1]) is not None:
+            raise RuntimeError(f'Duplicate image path {path}')
+        node = Node(parts[-1], size)
+        parent.children.append(node)
+        return node
+
+    def cluster_offset(self, cluster):
+        return (self.data_sector + (cluster - 2) * self.sectors_per_cluster) * SECTOR_SIZE
+
+    def directory_entries(self, node, parent):
+        date, dostime = dos_datetime(self.timestamp)
+        entries = []
+        if node is self.root:
+            entries.append(DirEntry.pack(self.label.ljust(11).encode('ascii', 'replace'), ATTR_VOLUME_ID, 0, 0, 0, 0, 0, 0, dostime, date, 0, 0))
+        else:
+            parent_cluster = 0 if parent is self.root else parent.cluster
+            for name, cluster in (('.', node.cluster), ('..', parent_cluster)):
+                entries.append(DirEntry.pack(name.encode().ljust(11), ATTR_DIRECTORY, 0, 0, dostime, date, date,
+                                             cluster >> 16, dostime, date, cluster & 0xFFFF, 0))
+
+        taken = set()
+        for child in node.children:
+            sname, needs_long = short_name(child.name, taken)
+            taken.add(sname)
+            if needs_long:
+                entries.extend(long_name_entries(child.name, short_name_checksum(sname)))
+            attr = ATTR_DIRECTORY if child.directory else ATTR_ARCHIVE
+            size = 0 if child.directory else child.size
+            entries.append(DirEntry.pack(sname, attr, 0, 0, dostime, date, date,
+                                         child.cluster >> 16, dostime, date, child.cluster & 0xFFFF, size))
+        return entries
+
+    def walk(self, node=None, parent=None):
+        node = self.root if node is None else node
+        yield node, parent
+        for child in node.children:
+            if child.directory:
+                yield from self.walk(child, node)
+        for child in node.children:
+            if not child.directory:
+                yield child, node
+
+    def allocate(self):
+        """
+        Assign contiguous cluster runs, directories first and then file data.
+        """
+        cluster = ROOT_CLUSTER
+        for node, _ in self.walk():
+            if node.directory:
+                # Entry count does not depend on cluster numbers, so size it up front.
+                count = len(self.directory_entries(node, self.root)) + 1
+                size = count * DirEntry.size
+            else:
+                size = node.size
+            node.clusters = -(-size // self.cluster_size)
+            if node.directory:
+                node.clusters = max(node.clusters, 1)
+            node.cluster = cluster if node.clusters > 0 else 0
+            node.offset = self.cluster_offset(cluster)
+            cluster += node.clusters
+        if cluster - 2 > self.cluster_count:
+            raise RuntimeError(f'Image needs {(cluster - 2) * self.cluster_size} bytes of data, but only {self.cluster_count * self.cluster_size} fit')
+        self.next_cluster = cluster
+
+    def boot_sector(self):
+        volume_id = int(self.timestamp * 1000) & 0xFFFFFFFF
+        sector = bytearray(SECTOR_SIZE)
+        sector[:BootSector.size] = BootSector.pack(
+            b'\xEB\x58\x90', b'mkfs.fat', SECTOR_SIZE, self.sectors_per_cluster, RESERVED_SECTORS, NUM_FATS,
+            0, 0, 0xF8, 0, 32, 64, 0, self.total_sectors, self.fat_sectors, 0, 0, ROOT_CLUSTER,
+            FSINFO_SECTOR, BACKUP_BOOT_SECTOR, bytes(12), 0x80, 0, 0x29, volume_id,
+            self.label.ljust(11).encode('ascii', 'replace'), b'FAT32   ')
+        # Boot code just halts; the image is only ever read by firmware file system drivers.
+        sector[BootSector.size:BootSector.size + 3] = b'\xF4\xEB\xFD'
+        sector[510:512] = b'\x55\xAA'
+        return bytes(sector)
+
+    def fsinfo_sector(self):
+        free = self.cluster_count - (self.next_cluster - 2)
+        sector = bytearray(SECTOR_SIZE)
+        struct.pack_into('<I', sector, 0, 0x41615252)
+        struct.pack_into('<III', sector, 484, 0x61417272, free, self.next_cluster)
+        struct.pack_into('<I', sector, 508, 0xAA550000)
+        return bytes(sector)
+
+    def fat(self):
+        fat = array.array('I', range(1, self.next_cluster + 1))
+        fat[0] = 0x0FFFFFF8
+        fat[1] = END_OF_CHAIN
+        for node, _ in self.walk():
+            if node.clusters > 0:
+                fat[node.cluster + node.clusters - 1] = END_OF_CHAIN
+        if struct.pack('=I', 1) != struct.pack('<I', 1):
+            fat.byteswap()
+        return fat.tobytes()
+
+    def write(self, fh):
+        """
+        Write all file system metadata to fh and size it to the full image. File data
+        regions are left as holes for the caller to fill in at each node's offset.
+        """
+        if self.next_cluster is None:
+            self.allocate()
+
+        fh.truncate(self.size)
+        boot = self.boot_sector()
+        fsinfo = self.fsinfo_sector()
+        for base in (0, BACKUP_BOOT_SECTOR):
+            fh.seek(base * SECTOR_SIZE)
+            fh.write(boot)
+            fh.write(fsinfo)
+            fh.seek((base + 2) * SECTOR_SIZE + 510)
+            fh.write(b'\x55\xAA')
+
+        # Whole FATs are written, so entries of an older layout in a reused image are cleared.
+        fat = self.fat().ljust(self.fat_sectors * SECTOR_SIZE, b'\0')
+        for index in range(NUM_FATS):
+            fh.seek((RESERVED_SECTORS + index * self.fat_sectors) * SECTOR_SIZE)
+            fh.write(fat)
+
+        for node, parent in self.walk():
+            if node.directory:
+                data = b''.join(self.directory_entries(node, parent))
+                fh.seek(node.offset)
+                fh.write(data.ljust(node.clusters * self.cluster_size, b'\0'))
+        fh.flush()
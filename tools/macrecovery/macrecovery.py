@@ -7,18 +7,36 @@ Copyright (c) 2019, vit9696
 """
 
 import argparse
+import array
+import asyncio
+import base64
+import bisect
+import concurrent.futures
+import contextlib
+import email.utils
+import functools
 import hashlib
+import itertools
 import json
 import linecache
+import mmap
 import os
 import random
-import struct
+import shlex
+import shutil
+import ssl
 import string
+import struct
 import sys
+import tempfile
+import threading
+import time
 
 try:
-    from urllib.request import Request, HTTPError, urlopen
-    from urllib.parse import urlparse
+    import http.client
+    import http.server
+    from urllib.parse import parse_qs, unquote, urlencode, urljoin, urlparse
+    from urllib.request import getproxies, proxy_bypass
 except ImportError:
     print('ERROR: Python 2 is not supported, please use Python 3')
     sys.exit(1)
@@ -44,23 +62,519 @@ INFO_SIGN_HASH = 'CH'
 INFO_SIGN_SESS = 'CT'
 INFO_REQURED = [INFO_PRODUCT, INFO_IMAGE_LINK, INFO_IMAGE_HASH, INFO_IMAGE_SESS, INFO_SIGN_LINK, INFO_SIGN_HASH, INFO_SIGN_SESS]
 
+# Recovery server, overridable by tools such as benchmark.py that run against a local stand-in
+RECOVERY_SERVER = 'http://osrecovery.apple.com'
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'macrecovery')
+CACHE_TTL = 3600
+CACHE_SIZE = 1024
+STORE_SIZE = 8 * 2**30
+
+# Linux FICLONE ioctl for copy-on-write clones
+FICLONE = 0x40049409
+
 # Use -2 for better resize stability on Windows
 TERMINAL_MARGIN = 2
 
-def run_query(url, headers, post=None, raw=False):
+# Progress lines are redrawn at most this often, in seconds
+PROGRESS_INTERVAL = 0.2
+
+# Idle keep-alive connections older than this are dropped instead of reused
+POOL_IDLE_TIMEOUT = 15
+MAX_REDIRECTS = 5
+
+# Network timeouts in seconds and retries of failed requests and transfer segments
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+RETRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8
+
+# A second metadata query is sent when the first takes longer than this, in seconds
+HEDGE_DELAY = 2
+
+# Transfers averaging less than STALL_FRACTION of their best rate, or less than
+# STALL_FLOOR bytes per second when set, over STALL_WINDOW seconds are abandoned.
+# The floor applies to each connection, so it is off unless --stall-floor sets it.
+STALL_WINDOW = 10
+STALL_FRACTION = 0.1
+STALL_FLOOR = 0
+
+# Bytes fetched from every candidate endpoint to rank them before a download
+PROBE_SIZE = 256 * 2**10
+PROBE_TIMEOUT = 5
+
+# HTTP statuses worth retrying, possibly on another endpoint
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Boards of a boards.json version tier whose latest product guess checks before sharing it with the tier
+GUESS_REPRESENTATIVES = 2
+
+# Files of a store entry that serve exposes to peers
+PEER_FILES = ('image.dmg', 'image.chunklist')
+
+
+class RecoveryError(RuntimeError):
+    """
+    Base class for failures, raised instead of exiting so that other tools can embed
+    macrecovery.
+    """
+
+
+class HTTPError(RecoveryError):
+    def __init__(self, status, reason, url):
+        super().__init__(f'"HTTP Error {status}: {reason}" when connecting to {url}')
+        self.status = status
+        self.reason = reason
+        self.url = url
+
+
+class SessionError(RecoveryError):
+    pass
+
+
+class ImageInfoError(RecoveryError):
+    pass
+
+
+class DownloadError(RecoveryError):
+    pass
+
+
+class NetworkError(RecoveryError):
+    """
+    Connection failures, timeouts and malformed responses left after all retries.
+    """
+
+
+class VerificationError(RecoveryError):
+    pass
+
+
+class ChunklistError(VerificationError):
+    pass
+
+
+class PooledResponse:
+    """
+    HTTP response that hands its connection back to the pool once the body is consumed.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def receive(self, read, amt):
+        try:
+            data = read(amt)
+        except (OSError, http.client.HTTPException) as err:
+            raise NetworkError(f'Reading {self.url} failed: {err or type(err).__name__}') from err
+        if self.response.isclosed():
+            self.finish()
+        return data
+
+    def read(self, amt=None):
+        return self.receive(self.response.read, amt)
+
+    def read1(self, amt=-1):
+        return self.receive(self.response.read1, amt)
+
+    def finish(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+    def close(self):
+        self.finish()
+        self.response.close()
+
+
+def proxy_for(purl):
+    """
+    Return the proxy urllib would use for a parsed URL from the environment, or None.
+    """
+    proxy = getproxies().get(purl.scheme)
+    if proxy is None or proxy_bypass(purl.netloc):
+        return None
+    return proxy if '://' in proxy else f'http://{proxy}'
+
+
+def proxy_headers(proxy):
+    """
+    Build Proxy-Authorization from the credentials in a proxy URL.
+    """
+    pproxy = urlparse(proxy)
+    if pproxy.username is None:
+        return {}
+    credentials = f'{unquote(pproxy.username)}:{unquote(pproxy.password or "")}'
+    return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode()}
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections keyed by scheme, host, port and proxy. Proxies are
+    taken from the environment like urllib does: plain HTTP requests go to the proxy
+    with absolute URIs, and HTTPS is tunnelled through it with CONNECT.
+    """
+
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.connections = 0
+        self.requests = 0
+
+    def acquire(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+            self.connections += 1
+
+        scheme, host, port, proxy = key
+        if proxy is not None:
+            pproxy = urlparse(proxy)
+            target = (host, port)
+            host, port = pproxy.hostname, pproxy.port
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=RETRY_POLICY.connect_timeout,
+                                               context=ssl.create_default_context())
+            if proxy is not None:
+                conn.set_tunnel(*target, headers=proxy_headers(proxy))
+            return conn, False
+        return http.client.HTTPConnection(host, port, timeout=RETRY_POLICY.connect_timeout), False
+
+    def release(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append((conn, time.monotonic()))
+
+    def request(self, method, url, headers, body=None):
+        purl = urlparse(url)
+        proxy = proxy_for(purl)
+        key = (purl.scheme, purl.hostname, purl.port, proxy)
+        path = purl.path or '/'
+        if purl.query:
+            path += '?' + purl.query
+        if proxy is not None and purl.scheme == 'http':
+            # Plain HTTP proxies take the absolute URI of the request.
+            path = f'http://{purl.netloc}{path}'
+            headers = {**headers, **proxy_headers(proxy)}
+
+        while True:
+            conn, reused = self.acquire(key)
+            try:
+                if conn.sock is None:
+                    # Connect with the connect timeout, then wait for data at most the read timeout.
+                    conn.connect()
+                    conn.sock.settimeout(RETRY_POLICY.read_timeout)
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # The server may drop an idle keep-alive connection at any time, so retry on a fresh one.
+                if reused:
+                    METRICS.add('retries')
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            return PooledResponse(self, key, conn, response, url)
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self.idle.clear()
+
+
+POOL = ConnectionPool()
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all downloads to keep their combined rate under a byte budget.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Set up by main when a bandwidth budget is given
+RATE_LIMITER = None
+
+
+class RetryPolicy:
+    """
+    Timeouts, retry budget and hedging for network requests. Waits between attempts
+    grow exponentially with full jitter, so clients failing together spread out.
+    """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES,
+                 hedge_delay=HEDGE_DELAY, stall_window=STALL_WINDOW, stall_floor=STALL_FLOOR):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.hedge_delay = hedge_delay
+        self.stall_window = stall_window
+        self.stall_floor = stall_floor
+
+    def backoff(self, attempt):
+        time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)))
+
+    def retryable(self, err):
+        if isinstance(err, HTTPError):
+            return err.status in RETRY_STATUSES
+        return isinstance(err, (NetworkError, OSError, http.client.HTTPException))
+
+
+# Replaced by main with the command line settings
+RETRY_POLICY = RetryPolicy()
+
+
+class StallDetector:
+    """
+    Abandon a transfer that slows to a crawl mid-way, see STALL_FRACTION. Transfers that
+    stop completely are caught by the read timeout instead.
+    """
+
+    def __init__(self, window=None):
+        self.window = RETRY_POLICY.stall_window if window is None else window
+        self.start = time.monotonic()
+        self.count = 0
+        self.best = 0
+
+    def update(self, count, offset):
+        self.count += count
+        elapsed = time.monotonic() - self.start
+        if self.window <= 0 or elapsed < self.window:
+            return
+        rate = self.count / elapsed
+        if rate < max(self.best * STALL_FRACTION, RETRY_POLICY.stall_floor):
+            METRICS.add('stalls')
+            raise DownloadError(f'Transfer stalled at {offset} bytes ({rate / 2**10:.0f} KB/s)')
+        self.best = max(self.best, rate)
+        self.start, self.count = time.monotonic(), 0
+
+    def throttle(self, count):
+        # Waiting for the rate limiter is not the connection's fault.
+        if RATE_LIMITER is not None:
+            start = time.monotonic()
+            RATE_LIMITER.consume(count)
+            self.start += time.monotonic() - start
+
+
+class Metrics:
+    """
+    Phase timings and counters, written as JSON Lines when an output is set. Counters are
+    process wide, so phases running concurrently (mirror) see each other's traffic.
+    """
+
+    def __init__(self, fh=None, action=None):
+        self.fh = fh
+        self.action = action
+        self.lock = threading.Lock()
+        self.counters = {'bytes': 0, 'hashed_bytes': 0, 'retries': 0, 'redirects': 0, 'hedges': 0, 'stalls': 0,
+                         'mirror_hits': 0, 'mirror_failures': 0}
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.counters[name] += count
+
+    def snapshot(self):
+        with self.lock:
+            values = dict(self.counters)
+        values['requests'] = POOL.requests
+        values['connections'] = POOL.connections
+        return values
+
+    def emit(self, event, **fields):
+        if self.fh is None:
+            return
+        record = {'time': round(time.time(), 3), 'pid': os.getpid(), 'action': self.action, 'event': event}
+        record.update(fields)
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.fh.write(line)
+            self.fh.flush()
+
+    def totals(self, before, seconds):
+        after = self.snapshot()
+        fields = {name: after[name] - before[name] for name in after}
+        fields['seconds'] = round(seconds, 6)
+        for name in ('bytes', 'hashed_bytes'):
+            if fields[name] > 0 and seconds > 0:
+                fields[name + '_per_second'] = round(fields[name] / seconds)
+        return fields
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        """
+        Time the enclosed block and emit it with the counter deltas. The yielded dict
+        may be updated with more fields for the record.
+        """
+        start = time.monotonic()
+        before = self.snapshot()
+        status = 'ok'
+        try:
+            yield fields
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            if self.fh is not None:
+                self.emit('phase', phase=name, status=status, **fields, **self.totals(before, time.monotonic() - start))
+
+
+# Replaced by main when --metrics-json is given
+METRICS = Metrics()
+
+
+class ProgressRenderer:
+    """
+    Single status line redrawn at most every interval seconds, so hot loops may report
+    on every block without their stdout writes adding up.
+    """
+
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last = 0.0
+        self.pending = None
+
+    def draw(self, render, force=False):
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.last < self.interval:
+                self.pending = render
+                return
+            self.last = now
+            self.pending = None
+            # Use -2 for better resize stability on Windows
+            width = shutil.get_terminal_size().columns - TERMINAL_MARGIN
+            print(f'\r{render(width):<{width}}', end='')
+            sys.stdout.flush()
+
+    def status(self, text):
+        self.draw(lambda width: text[:width])
+
+    def flush(self):
+        """
+        Draw the latest update if it was held back, before moving on to a new line.
+        """
+        render = self.pending
+        if render is not None:
+            self.draw(render, force=True)
+
+
+PROGRESS = ProgressRenderer()
+
+# Disabled when several downloads share the terminal
+SHOW_PROGRESS = True
+
+
+def run_query(url, headers, post=None, raw=False, retries=None):
+    """
+    Request url, retrying connection failures, timeouts and RETRY_STATUSES up to retries
+    times (RETRY_POLICY.retries by default) after a jittered backoff.
+    """
+    retries = RETRY_POLICY.retries if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            return run_query_once(url, headers, post, raw)
+        except Exception as err:
+            if attempt == retries or not RETRY_POLICY.retryable(err):
+                if isinstance(err, (OSError, http.client.HTTPException)):
+                    raise NetworkError(f'Connecting to {url} failed: {err or type(err).__name__}') from err
+                raise
+        METRICS.add('retries')
+        RETRY_POLICY.backoff(attempt)
+
+
+def run_hedged(func, *args, **kwargs):
+    """
+    Call func, starting an identical second call if the first has not finished after
+    RETRY_POLICY.hedge_delay seconds, and return the result that arrives first. Only
+    used for idempotent metadata queries, where a slow server costs more than a
+    duplicate request.
+    """
+    if RETRY_POLICY.hedge_delay <= 0:
+        return func(*args, **kwargs)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = [executor.submit(func, *args, **kwargs)]
+        done, _ = concurrent.futures.wait(futures, timeout=RETRY_POLICY.hedge_delay)
+        if not done:
+            METRICS.add('hedges')
+            futures.append(executor.submit(func, *args, **kwargs))
+        error = None
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                return future.result()
+            except Exception as err:
+                error = err
+        raise error
+    finally:
+        # The slower call finishes in the background and returns its connection to the pool.
+        executor.shutdown(wait=False)
+
+
+def run_query_once(url, headers, post=None, raw=False):
     if post is not None:
         data = '\n'.join(entry + '=' + post[entry] for entry in post).encode()
     else:
         data = None
-    req = Request(url=url, headers=headers, data=data)
-    try:
-        response = urlopen(req)
+
+    for _ in range(MAX_REDIRECTS + 1):
+        response = POOL.request('GET' if data is None else 'POST', url, headers, data)
+        location = response.getheader('Location')
+        if response.status in (301, 302, 303, 307, 308) and location is not None:
+            response.read()
+            response.close()
+            METRICS.add('redirects')
+            url = urljoin(url, location)
+            headers = dict(headers, Host=urlparse(url).hostname)
+            if response.status == 303:
+                data = None
+            continue
+        if response.status >= 400:
+            response.read()
+            response.close()
+            raise HTTPError(response.status, response.reason, url)
         if raw:
             return response
         return dict(response.info()), response.read()
-    except HTTPError as e:
-        print(f'ERROR: "{e}" when connecting to {url}')
-        sys.exit(1)
+
+    raise HTTPError(response.status, 'Too many redirects', url)
 
 
 def generate_id(id_type, id_value=None):
@@ -89,12 +603,17 @@ Chunk = struct.Struct('<I32s')
 assert Chunk.size == 0x24
 
 
-def verify_chunklist(cnkpath):
-    with open(cnkpath, 'rb') as f:
-        hash_ctx = hashlib.sha256()
-        data = f.read(ChunkListHeader.size)
-        hash_ctx.update(data)
-        magic, header_size, file_version, chunk_method, signature_method, chunk_count, chunk_offset, signature_offset = ChunkListHeader.unpack(data)
+class ChunkList:
+    """
+    Parsed chunklist with its signature checked once up front. Sizes and cumulative
+    offsets are kept in arrays and digests in one contiguous buffer, so any chunk or
+    byte range can be looked up and verified in any order. Iterating yields
+    (size, digest) pairs.
+    """
+
+    def __init__(self, data):
+        assert len(data) >= ChunkListHeader.size
+        magic, header_size, file_version, chunk_method, signature_method, chunk_count, chunk_offset, signature_offset = ChunkListHeader.unpack_from(data)
         assert magic == b'CNKL'
         assert header_size == ChunkListHeader.size
         assert file_version == 1
@@ -103,37 +622,157 @@ def verify_chunklist(cnkpath):
         assert chunk_count > 0
         assert chunk_offset == 0x24
         assert signature_offset == chunk_offset + Chunk.size * chunk_count
-        for _ in range(chunk_count):
-            data = f.read(Chunk.size)
-            hash_ctx.update(data)
-            chunk_size, chunk_sha256 = Chunk.unpack(data)
-            yield chunk_size, chunk_sha256
-        digest = hash_ctx.digest()
+        assert len(data) >= signature_offset
+
+        self.hexdigest = hashlib.sha256(data).hexdigest()
+        digest = hashlib.sha256(memoryview(data)[:signature_offset]).digest()
+        signature = data[signature_offset:]
         if signature_method == 1:
-            data = f.read(256)
-            assert len(data) == 256
-            signature = int.from_bytes(data, 'little')
+            assert len(signature) == 256
+            signature = int.from_bytes(signature, 'little')
             plaintext = int(f'0x1{"f"*404}003031300d060960864801650304020105000420{"0"*64}', 16) | int.from_bytes(digest, 'big')
             assert pow(signature, 0x10001, Apple_EFI_ROM_public_key_1) == plaintext
         elif signature_method == 2:
-            data = f.read(32)
-            assert data == digest
-            raise RuntimeError('Chunklist missing digital signature')
+            assert signature == digest
+            raise ChunklistError('Chunklist missing digital signature')
         else:
             raise NotImplementedError
-        assert f.read(1) == b''
+
+        entries = memoryview(data)[chunk_offset:signature_offset]
+        self.sizes = array.array('I', [size for size, in struct.iter_unpack('<I32x', entries)])
+        self.offsets = array.array('Q', itertools.accumulate(self.sizes, initial=0))
+        self.digests = b''.join(digest for digest, in struct.iter_unpack('<4x32s', entries))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.sizes)
+        return self.sizes[index], self.digest(index)
+
+    def __iter__(self):
+        for index, size in enumerate(self.sizes):
+            yield size, self.digests[index * 32:index * 32 + 32]
+
+    @property
+    def total_size(self):
+        return self.offsets[-1]
+
+    def digest(self, index):
+        return self.digests[index * 32:index * 32 + 32]
+
+    def check(self, index, data):
+        """
+        Raise if data is not the exact content of chunk index.
+        """
+        if len(data) != self.sizes[index]:
+            raise VerificationError(f'Invalid chunk {index + 1} size: expected {self.sizes[index]}, read {len(data)}')
+        if hashlib.sha256(data).digest() != self.digest(index):
+            raise VerificationError(f'Invalid chunk {index + 1}: hash mismatch')
+
+    def chunks_covering(self, offset, length):
+        """
+        Return the range of chunk indices overlapping length bytes from offset.
+        """
+        if length <= 0 or offset >= self.total_size:
+            return range(0)
+        first = bisect.bisect_right(self.offsets, offset) - 1
+        last = bisect.bisect_left(self.offsets, offset + length)
+        return range(max(first, 0), min(last, len(self.sizes)))
+
+    def verify_range(self, fileobj, offset, length):
+        """
+        Verify every chunk overlapping length bytes from offset in fileobj, returning the
+        range of chunk indices checked.
+        """
+        chunks = self.chunks_covering(offset, length)
+        for index in chunks:
+            fileobj.seek(self.offsets[index])
+            self.check(index, fileobj.read(self.sizes[index]))
+        return chunks
+
+
+def verify_chunklist(cnkpath):
+    with open(cnkpath, 'rb') as f:
+        data = f.read()
+    try:
+        return ChunkList(data)
+    except AssertionError as err:
+        raise ChunklistError(f'Invalid chunklist: {verification_error(err)}') from err
+
+
+def stamp_path(dmgpath):
+    return dmgpath + '.verified'
+
+
+def file_state(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'inode': st.st_ino}
+
+
+def is_verified(bitmap, index):
+    return bitmap[index >> 3] & (1 << (index & 7)) != 0
+
+
+def mark_verified(bitmap, index):
+    bitmap[index >> 3] |= 1 << (index & 7)
+
+
+def load_stamp(dmgpath, chunks):
+    """
+    Return the bitmap of chunks recorded as verified in the stamp next to dmgpath. The
+    bitmap is empty when there is no stamp, or when the image or chunklist changed since
+    the stamp was written.
+    """
+    bitmap = bytearray(-(-len(chunks) // 8))
+    try:
+        with open(stamp_path(dmgpath), 'r', encoding='utf-8') as fh:
+            stamp = json.load(fh)
+        verified = bytes.fromhex(stamp['verified'])
+        # Images larger than the chunklist are always invalid, so never trust their stamps.
+        if stamp['chunklist'] == chunks.hexdigest and len(verified) == len(bitmap) and stamp['size'] <= chunks.total_size \
+                and all(stamp[key] == value for key, value in file_state(dmgpath).items()):
+            bitmap[:] = verified
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return bitmap
+
+
+def save_stamp(dmgpath, chunks, bitmap=None, state=None):
+    """
+    Record the chunks of dmgpath set in bitmap (all of them by default) as verified. The
+    stamp is only written if dmgpath still matches state, taken before hashing started.
+    """
+    if bitmap is None:
+        bitmap = b'\xff' * (-(-len(chunks) // 8))
+    try:
+        current = file_state(dmgpath)
+        if state is not None and state != current:
+            os.remove(stamp_path(dmgpath))
+            return
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dmgpath)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+                json.dump(dict(current, chunklist=chunks.hexdigest, verified=bytes(bitmap).hex()), fh)
+            os.replace(tmppath, stamp_path(dmgpath))
+        except OSError:
+            os.remove(tmppath)
+            raise
+    except OSError:
+        pass
 
 
-def get_session(args):
+def get_session(verbose=False):
     headers = {
-        'Host': 'osrecovery.apple.com',
-        'Connection': 'close',
+        'Host': urlparse(RECOVERY_SERVER).netloc,
         'User-Agent': 'InternetRecovery/1.0',
     }
 
-    headers, _ = run_query('http://osrecovery.apple.com/', headers)
+    with METRICS.phase('session'):
+        headers, _ = run_hedged(run_query, f'{RECOVERY_SERVER}/', headers)
 
-    if args.verbose:
+    if verbose:
         print('Session headers:')
         for header in headers:
             print(f'{header}: {headers[header]}')
@@ -144,123 +783,1290 @@ def get_session(args):
             for cookie in cookies:
                 return cookie if cookie.startswith('session=') else ...
 
-    raise RuntimeError('No session in headers ' + str(headers))
+    raise SessionError('No session in headers ' + str(headers))
 
 
-def get_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None):
-    headers = {
-        'Host': 'osrecovery.apple.com',
-        'Connection': 'close',
-        'User-Agent': 'InternetRecovery/1.0',
-        'Cookie': session,
-        'Content-Type': 'text/plain',
-    }
-
-    post = {
-        'cid': generate_id(TYPE_SID, cid),
-        'sn': mlb,
-        'bid': bid,
-        'k': generate_id(TYPE_K),
-        'fg': generate_id(TYPE_FG)
-    }
+class InfoCache:
+    """
+    On-disk TTL cache of parsed image info keyed by (board_id, mlb, os_type, diag).
+    Entries are replaced atomically, so several processes may share the directory, and
+    the least recently used entries are evicted once there are more than size of them.
+    """
 
-    if diag:
-        url = 'http://osrecovery.apple.com/InstallationPayload/Diagnostics'
-    else:
-        url = 'http://osrecovery.apple.com/InstallationPayload/RecoveryImage'
-        post['os'] = os_type
+    def __init__(self, directory, ttl=CACHE_TTL, size=CACHE_SIZE, refresh=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.size = size
+        self.refresh = refresh
 
-    headers, output = run_query(url, headers, post)
+    def path(self, bid, mlb, os_type, diag):
+        key = json.dumps([bid, mlb, os_type, diag])
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + '.json')
 
-    output = output.decode('utf-8')
-    info = {}
-    for line in output.split('\n'):
+    def get(self, bid, mlb, os_type, diag):
+        if self.refresh:
+            return None
+        path = self.path(bid, mlb, os_type, diag)
         try:
-            key, value = line.split(': ')
-            info[key] = value
-        except KeyError:
-            continue
-        except ValueError:
-            continue
+            with open(path, 'r', encoding='utf-8') as fh:
+                entry = json.load(fh)
+            if time.time() - entry['time'] > self.ttl:
+                return None
+            # Access time is tracked through mtime, which LRU eviction sorts by.
+            os.utime(path)
+            return entry['info']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def put(self, bid, mlb, os_type, diag, info):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+                json.dump({'time': time.time(), 'info': info}, fh)
+            os.replace(tmppath, self.path(bid, mlb, os_type, diag))
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                try:
+                    entries.append((os.stat(os.path.join(self.directory, name)).st_mtime, name))
+                except FileNotFoundError:
+                    continue
+        entries.sort()
+        for _, name in entries[:max(len(entries) - self.size, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
 
-    for k in INFO_REQURED:
-        if k not in info:
-            raise RuntimeError(f'Missing key {k}')
 
+# Set up by main unless caching is disabled
+INFO_CACHE = None
+
+
+def peer_image_info(mirror, bid, mlb, os_type, diag):
+    """
+    Look up image info cached by a peer running serve, returning None when it has none.
+    """
+    query = urlencode({'bid': bid, 'mlb': mlb, 'os': os_type, 'diag': int(diag)})
+    url = f'{mirror.rstrip("/")}/info?{query}'
+    try:
+        _, output = run_query(url, {'Host': urlparse(url).netloc, 'User-Agent': 'InternetRecovery/1.0'}, retries=0)
+        info = json.loads(output)
+    except (RecoveryError, OSError, http.client.HTTPException, ValueError):
+        return None
+    if not isinstance(info, dict) or any(not isinstance(info.get(k), str) for k in INFO_REQURED):
+        return None
     return info
 
 
-def save_image(url, sess, filename='', directory=''):
-    purl = urlparse(url)
-    headers = {
-        'Host': purl.hostname,
-        'Connection': 'close',
+def get_image_info(session, bid, mlb=MLB_ZERO, diag=False, os_type='default', cid=None, cached=True, mirrors=()):
+    with METRICS.phase('image_info', board=bid, os_type='diagnostics' if diag else os_type) as phase:
+        if cached and INFO_CACHE is not None:
+            info = INFO_CACHE.get(bid, mlb, os_type, diag)
+            if info is not None:
+                phase['cached'] = True
+                return info
+
+        # Peers act as a shared cache, so fresh info (cached=False) always comes from Apple.
+        for mirror in mirrors if cached else ():
+            info = peer_image_info(mirror, bid, mlb, os_type, diag)
+            if info is not None:
+                phase['mirror'] = mirror
+                if INFO_CACHE is not None:
+                    INFO_CACHE.put(bid, mlb, os_type, diag, info)
+                return info
+
+        headers = {
+            'Host': urlparse(RECOVERY_SERVER).netloc,
+            'User-Agent': 'InternetRecovery/1.0',
+            'Cookie': session,
+            'Content-Type': 'text/plain',
+        }
+
+        post = {
+            'cid': generate_id(TYPE_SID, cid),
+            'sn': mlb,
+            'bid': bid,
+            'k': generate_id(TYPE_K),
+            'fg': generate_id(TYPE_FG)
+        }
+
+        if diag:
+            url = f'{RECOVERY_SERVER}/InstallationPayload/Diagnostics'
+        else:
+            url = f'{RECOVERY_SERVER}/InstallationPayload/RecoveryImage'
+            post['os'] = os_type
+
+        headers, output = run_hedged(run_query, url, headers, post)
+
+        output = output.decode('utf-8')
+        info = {}
+        for line in output.split('\n'):
+            try:
+                key, value = line.split(': ')
+                info[key] = value
+            except KeyError:
+                continue
+            except ValueError:
+                continue
+
+        for k in INFO_REQURED:
+            if k not in info:
+                raise ImageInfoError(f'Missing key {k}')
+
+        if INFO_CACHE is not None:
+            INFO_CACHE.put(bid, mlb, os_type, diag, info)
+
+        return info
+
+
+def format_progress(size, totalsize, terminalsize):
+    if totalsize > 0:
+        progress = size / totalsize
+        barwidth = terminalsize // 3
+        line = f'{size / (2**20):.1f}/{totalsize / (2**20):.1f} MB '
+        if terminalsize > 55:
+            line += f'|{"=" * int(barwidth * progress):<{barwidth}}|'
+        return line + f' {progress*100:.1f}% downloaded'
+    # Fallback if Content-Length isn't available
+    return f'{size / (2**20)} MB downloaded...'
+
+
+def print_progress(size, totalsize):
+    if SHOW_PROGRESS:
+        PROGRESS.draw(lambda terminalsize: format_progress(size, totalsize, terminalsize), force=size == totalsize)
+
+
+def get_header(headers, name):
+    for header in headers:
+        if header.lower() == name:
+            return headers[header]
+    return None
+
+
+class FileRegion:
+    """
+    Fixed window of an open file, used to stream a download into space preallocated
+    inside a larger disk image. Offsets are relative to the start of the window.
+    """
+
+    def __init__(self, fh, base, size):
+        self.fh = fh
+        self.base = base
+        self.size = size
+        self.pos = 0
+
+    def __str__(self):
+        return f'{self.fh.name} at offset {self.base}'
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def seek(self, offset):
+        self.pos = offset
+
+    def read(self, size):
+        self.fh.seek(self.base + self.pos)
+        data = self.fh.read(max(min(size, self.size - self.pos), 0))
+        self.pos += len(data)
+        return data
+
+    def truncate(self, size):
+        # The window stays allocated, only growing past it is an error.
+        if size > self.size:
+            raise VerificationError(f'Invalid image: size {size} does not fit into {self.size} preallocated bytes')
+
+
+# Serialises seek and write where os.pwrite is missing, such as on Windows
+SEEK_WRITE_LOCK = threading.Lock()
+
+
+def write_at(fh, data, offset):
+    if isinstance(fh, FileRegion):
+        if offset + len(data) > fh.size:
+            raise VerificationError(f'Invalid image: write past {fh.size} preallocated bytes')
+        offset += fh.base
+        fh = fh.fh
+    # Positional writes let concurrent segments share a single descriptor.
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fh.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        # Segment threads share the file position, so seek and write together.
+        with SEEK_WRITE_LOCK:
+            fh.seek(offset)
+            fh.write(data)
+
+
+def parse_content_range(value):
+    # Content-Range: bytes START-END/TOTAL
+    try:
+        unit, spec = value.split(' ', 1)
+        span, total = spec.split('/')
+        start, end = span.split('-')
+        if unit != 'bytes':
+            return None
+        return int(start), int(end), int(total)
+    except ValueError:
+        return None
+
+
+class ChunkHasher:
+    """
+    Check sequentially arriving image data against chunklist entries starting at chunk first.
+    """
+
+    def __init__(self, chunks, first=0):
+        self.chunks = chunks
+        self.index = first
+        self.hash_ctx = hashlib.sha256()
+        self.remaining = chunks.sizes[first] if first < len(chunks) else 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            if self.index >= len(self.chunks):
+                raise VerificationError('Invalid image: larger than chunklist')
+            part = view[:self.remaining]
+            self.hash_ctx.update(part)
+            self.remaining -= len(part)
+            view = view[len(part):]
+            if self.remaining == 0:
+                if self.hash_ctx.digest() != self.chunks.digest(self.index):
+                    raise VerificationError(f'Invalid chunk {self.index + 1}: hash mismatch')
+                self.index += 1
+                self.hash_ctx = hashlib.sha256()
+                if self.index < len(self.chunks):
+                    self.remaining = self.chunks.sizes[self.index]
+
+    def finish(self, last=None):
+        last = len(self.chunks) if last is None else last
+        if self.index < last:
+            cnksize = self.chunks.sizes[self.index]
+            raise VerificationError(f'Invalid chunk {self.index + 1} size: expected {cnksize}, read {cnksize - self.remaining}')
+
+
+def stream_segment(response, fh, start, end, progress, abort, hasher=None):
+    offset = start
+    stall = StallDetector()
+    while offset < end and not abort.is_set():
+        # read1 returns what has arrived, so a trickling connection cannot block stall checks.
+        chunk = response.read1(min(2**20, end - offset))
+        if not chunk:
+            raise DownloadError(f'Connection closed at {offset} bytes, expected {end}')
+        if hasher is not None:
+            hasher.update(chunk)
+        write_at(fh, chunk, offset)
+        offset += len(chunk)
+        METRICS.add('bytes', len(chunk))
+        progress(len(chunk))
+        stall.throttle(len(chunk))
+        stall.update(len(chunk), offset)
+    response.close()
+
+
+def split_segments(start, totalsize, connections, chunks=None, first=0):
+    """
+    Split the image from start into (start, end, first chunk, last chunk) segments, keeping
+    chunk boundaries when a chunklist is available so that every segment can be verified on its own.
+    """
+    segsize = -(-(totalsize - start) // connections)
+    if chunks is None:
+        return [(offset, min(offset + segsize, totalsize), None, None) for offset in range(start, totalsize, segsize)]
+
+    segments = []
+    while first < len(chunks):
+        # Cut at the first chunk boundary at least segsize past the segment start.
+        last = min(bisect.bisect_left(chunks.offsets, start + segsize), len(chunks))
+        end = chunks.offsets[last]
+        segments.append((start, end, first, last))
+        start, first = end, last
+    return segments
+
+
+def open_range(url, headers, start, end):
+    response = run_query(url, dict(headers, Range=f'bytes={start}-{end - 1}'), raw=True)
+    crange = get_header(dict(response.headers), 'content-range')
+    if response.status != 206 or crange is None or parse_content_range(crange)[0] != start:
+        response.close()
+        raise DownloadError(f'Server ignored range request for {start}-{end - 1}')
+    return response
+
+
+def verified_prefix(fh, chunks, verified=None):
+    """
+    Find the end of the leading run of whole chunks in fh that match the chunklist.
+    Chunks set in the verified bitmap are trusted without hashing them again.
+    """
+    for index in range(len(chunks)):
+        if verified is not None and is_verified(verified, index):
+            continue
+        try:
+            chunks.verify_range(fh, chunks.offsets[index], 1)
+        except VerificationError:
+            return chunks.offsets[index], index
+    return chunks.total_size, len(chunks)
+
+
+def fetch_segments(endpoints, fh, segments, totalsize, done, connections, chunks=None, response=None):
+    """
+    Fetch (start, end, first chunk, last chunk) segments of the image available from the
+    (url, headers) endpoints into fh over at most connections parallel range requests.
+    An already open response from the first endpoint may serve the first segment. A
+    segment that fails, stalls or gets a bad chunk keeps its verified chunks and
+    continues from the next endpoint, up to RETRY_POLICY.retries more times.
+    """
+    lock = threading.Lock()
+    abort = threading.Event()
+    done = [done]
+    attempts = RETRY_POLICY.retries + len(endpoints)
+
+    def progress(count):
+        with lock:
+            done[0] += count
+            print_progress(done[0], totalsize)
+
+    def fetch(index):
+        segstart, segend, segfirst, seglast = segments[index]
+        segresponse = response if index == 0 else None
+        for attempt in range(attempts):
+            if segstart >= segend:
+                return
+            url, headers = endpoints[attempt % len(endpoints)]
+            hasher = ChunkHasher(chunks, segfirst) if chunks is not None else None
+            received = [0]
+
+            def segprogress(count):
+                received[0] += count
+                progress(count)
+
+            try:
+                if segresponse is None:
+                    segresponse = open_range(url, headers, segstart, segend)
+                stream_segment(segresponse, fh, segstart, segend, segprogress, abort, hasher)
+                if hasher is not None and not abort.is_set():
+                    hasher.finish(seglast)
+                return
+            except BaseException as err:
+                if segresponse is not None:
+                    segresponse.close()
+                    segresponse = None
+                if abort.is_set() or attempt + 1 == attempts or not isinstance(err, (RecoveryError, OSError, http.client.HTTPException)):
+                    abort.set()
+                    raise
+                # Only whole verified chunks are kept, the rest of the segment is fetched again.
+                resume = chunks.offsets[hasher.index] if hasher is not None else segstart + received[0]
+                progress(resume - segstart - received[0])
+                if hasher is not None:
+                    segfirst = hasher.index
+                segstart = resume
+                PROGRESS.flush()
+                print(f'\rWARN: Segment from {url} failed ({verification_error(err)}), retrying from {resume} bytes')
+                METRICS.add('retries')
+                RETRY_POLICY.backoff(attempt // len(endpoints))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(connections, len(segments))) as executor:
+        futures = [executor.submit(fetch, index) for index in range(len(segments))]
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+
+def save_image_ranged(endpoints, fh, response, start, totalsize, connections, chunks=None, first=0):
+    # The first response already covers the file from start, so it serves the first
+    # segment and only the remaining segments need new requests.
+    fh.truncate(totalsize)
+    segments = split_segments(start, totalsize, connections, chunks, first)
+    fetch_segments(endpoints, fh, segments, totalsize, start, connections, chunks, response)
+
+
+def asset_headers(url, sess):
+    return {
+        'Host': urlparse(url).hostname,
         'User-Agent': 'InternetRecovery/1.0',
         'Cookie': '='.join(['AssetToken', sess])
     }
 
+
+def prepare_download(url, sess, filename, directory):
+    purl = urlparse(url)
+    headers = asset_headers(url, sess)
+
     if not os.path.exists(directory):
         os.makedirs(directory)
 
     if filename == '':
         filename = os.path.basename(purl.path)
     if filename.find(os.sep) >= 0 or filename == '':
-        raise RuntimeError('Invalid save path ' + filename)
+        raise RecoveryError('Invalid save path ' + filename)
 
-    print(f'Saving {url} to {directory}{os.sep}{filename}...')
+    path = os.path.join(directory, filename)
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        # Never write through a hardlink shared with the image store.
+        os.remove(path)
+    return headers, path
 
-    with open(os.path.join(directory, filename), 'wb') as fh:
-        response = run_query(url, headers, raw=True)
-        headers = dict(response.headers)
-        totalsize = -1
-        for header in headers:
-            if header.lower() == 'content-length':
-                totalsize = int(headers[header])
-                break
-        size = 0
-        oldterminalsize = 0
+
+def save_image_delta(url, sess, filename, directory, chunks, index, connections=1):
+    """
+    Assemble the image from chunks found in index (chunk hash to stored image path and
+    offset), fetching only the missing byte ranges from url.
+    """
+    headers, path = prepare_download(url, sess, filename, directory)
+    totalsize = chunks.total_size
+
+    print(f'Saving {url} to {path} reusing stored chunks...')
+
+    with open(path, 'wb') as fh:
+        fh.truncate(totalsize)
+        missing = []
+        saved = 0
+        offset = 0
+        sources = {}
+        try:
+            for cnkindex, (cnksize, cnkhash) in enumerate(chunks):
+                cnk = None
+                if cnkhash in index:
+                    srcpath, srcoffset = index[cnkhash]
+                    if srcpath not in sources:
+                        sources[srcpath] = open(srcpath, 'rb')
+                    sources[srcpath].seek(srcoffset)
+                    cnk = sources[srcpath].read(cnksize)
+                if cnk is not None and len(cnk) == cnksize and hashlib.sha256(cnk).digest() == cnkhash:
+                    write_at(fh, cnk, offset)
+                    saved += cnksize
+                elif missing and missing[-1][1] == offset:
+                    missing[-1][1] += cnksize
+                    missing[-1][3] = cnkindex + 1
+                else:
+                    missing.append([offset, offset + cnksize, cnkindex, cnkindex + 1])
+                offset += cnksize
+        finally:
+            for source in sources.values():
+                source.close()
+
+        print(f'Reused {saved / (2**20):.1f} MB from stored images, fetching {(totalsize - saved) / (2**20):.1f} MB')
+
+        if missing:
+            try:
+                response = open_range(url, headers, missing[0][0], missing[0][1])
+            except RecoveryError:
+                response = None
+            if response is not None:
+                fetch_segments([(url, headers)], fh, [tuple(segment) for segment in missing], totalsize, saved, connections, chunks, response)
+
+    if missing and response is None:
+        print('Server does not support range requests, downloading the whole image')
+        return save_image(url, sess, filename, directory, connections, chunks)
+
+    PROGRESS.flush()
+    print(f'\nDownload complete! Saved {saved / (2**20):.1f} MB of {totalsize / (2**20):.1f} MB')
+    return path
+
+
+def download_into(url, headers, fh, connections=1, chunks=None, resume=False, verified=None, alternates=()):
+    """
+    Download url into the open file or FileRegion fh. When a ChunkList is given, every
+    chunk is checked as it arrives and the download aborts on the first mismatch. With
+    resume, the verified leading chunks already in fh are kept and only the rest is
+    fetched; chunks set in the verified bitmap are not hashed again. Failing or stalling
+    range requests move on to the (url, headers) alternates, see fetch_segments.
+    """
+    start, first = 0, 0
+    if resume:
+        start, first = verified_prefix(fh, chunks, verified)
+        fh.truncate(start)
+        if first == len(chunks):
+            print('Image already downloaded and verified!')
+            return
+        print(f'Resuming from chunk {first + 1} at {start} bytes...')
+
+    # Open-ended range lets us detect Range support without an extra round trip, and
+    # ranged transfers can continue elsewhere when the connection fails.
+    # With alternates left, a failing endpoint is not worth retrying.
+    response = run_query(url, dict(headers, Range=f'bytes={start}-'), raw=True, retries=0 if alternates else None)
+    rheaders = dict(response.headers)
+    crange = get_header(rheaders, 'content-range')
+    crange = parse_content_range(crange) if crange is not None else None
+    ranged = response.status == 206 and crange is not None and crange[0] == start
+    if ranged:
+        totalsize = crange[2]
+        if chunks is not None and totalsize != chunks.total_size:
+            response.close()
+            raise VerificationError(f'Invalid image: size {totalsize} does not match chunklist')
+    else:
+        if connections > 1 or start > 0:
+            print('Server does not support range requests, downloading over a single connection from the start')
+            fh.truncate(0)
+            start, first = 0, 0
+        totalsize = int(get_header(rheaders, 'content-length') or -1)
+
+    if ranged:
+        save_image_ranged([(url, headers)] + list(alternates), fh, response, start, totalsize, connections, chunks, first)
+    else:
+        hasher = ChunkHasher(chunks, first) if chunks is not None else None
+        stall = StallDetector()
+        size = start
         while True:
-            chunk = response.read(2**20)
+            chunk = response.read1(2**20)
             if not chunk:
                 break
-            fh.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+            write_at(fh, chunk, size)
             size += len(chunk)
-            terminalsize = 80
-            if oldterminalsize != terminalsize:
-                print(f'\r{"":<{terminalsize}}', end='')
-                oldterminalsize = terminalsize
-            if totalsize > 0:
-                progress = size / totalsize
-                barwidth = terminalsize // 3
-                print(f'\r{size / (2**20):.1f}/{totalsize / (2**20):.1f} MB ', end='')
-                if terminalsize > 55:
-                    print(f'|{"=" * int(barwidth * progress):<{barwidth}}|', end='')
-                print(f' {progress*100:.1f}% downloaded', end='')
-            else:
-                # Fallback if Content-Length isn't available
-                print(f'\r{size / (2**20)} MB downloaded...', end='')
-            sys.stdout.flush()
-        print('\nDownload complete!')
+            METRICS.add('bytes', len(chunk))
+            print_progress(size, totalsize)
+            stall.throttle(len(chunk))
+            stall.update(len(chunk), size)
+        if hasher is not None:
+            hasher.finish()
+    PROGRESS.flush()
+    print('\nDownload complete!')
 
-    return os.path.join(directory, os.path.basename(filename))
 
+def mirror_links(mirrors, product, digest):
+    """
+    Return the image links of product on each peer, addressed like the ImageStore by
+    the sha256 hex digest of its chunklist.
+    """
+    return [f'{mirror.rstrip("/")}/images/{product}/{digest}/image.dmg' for mirror in mirrors]
 
-def verify_image(dmgpath, cnkpath):
-    print('Verifying image with chunklist...')
 
-    with open(dmgpath, 'rb') as dmgf:
-        for cnkcount, (cnksize, cnkhash) in enumerate(verify_chunklist(cnkpath), 1):
-            terminalsize = 80
-            print(f'\r{f"Chunk {cnkcount} ({cnksize} bytes)":<{terminalsize}}', end='')
-            sys.stdout.flush()
-            cnk = dmgf.read(cnksize)
-            if len(cnk) != cnksize:
-                raise RuntimeError(f'Invalid chunk {cnkcount} size: expected {cnksize}, read {len(cnk)}')
-            if hashlib.sha256(cnk).digest() != cnkhash:
-                raise RuntimeError(f'Invalid chunk {cnkcount}: hash mismatch')
-        if dmgf.read(1) != b'':
-            raise RuntimeError('Invalid image: larger than chunklist')
-        print('\nImage verification complete!')
+def image_endpoints(url, headers, mirrors=()):
+    """
+    Return the (url, headers) endpoints serving an image: the mirror links, then the
+    Apple link and, for a plain HTTP link without a port, the same link over HTTPS.
+    HTTPS links never fall back to HTTP, which would send the AssetToken in the clear.
+    """
+    endpoints = [(link, {'Host': urlparse(link).netloc, 'User-Agent': 'InternetRecovery/1.0'}) for link in mirrors]
+    endpoints.append((url, headers))
+    purl = urlparse(url)
+    if purl.scheme == 'http' and purl.port is None:
+        endpoints.append((purl._replace(scheme='https').geturl(), headers))
+    return endpoints
+
+
+def probe_endpoint(url, headers):
+    """
+    Fetch the first PROBE_SIZE bytes of url and return the throughput in bytes per second.
+    """
+    start = time.monotonic()
+    response = run_query(url, dict(headers, Range=f'bytes=0-{PROBE_SIZE - 1}'), raw=True, retries=0)
+    try:
+        if response.status != 206:
+            raise DownloadError(f'{url} does not support range requests')
+        size = len(response.read())
+    finally:
+        response.close()
+    METRICS.add('bytes', size)
+    return size / max(time.monotonic() - start, 1e-6)
+
+
+def rank_endpoints(endpoints, mirrors=0):
+    """
+    Probe all endpoints at once for at most PROBE_TIMEOUT seconds and order them by
+    throughput. The first mirrors endpoints (peers) stay ahead of the rest, since they
+    exist to keep traffic off the WAN; endpoints that fail or are too slow go last.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(endpoints))
+    try:
+        futures = [executor.submit(probe_endpoint, url, headers) for url, headers in endpoints]
+        concurrent.futures.wait(futures, timeout=PROBE_TIMEOUT)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    rates = []
+    for index, future in enumerate(futures):
+        if future.done() and future.exception() is None:
+            rates.append(future.result())
+        else:
+            rates.append(None)
+    order = sorted(range(len(endpoints)), key=lambda index: (rates[index] is None, index >= mirrors, -(rates[index] or 0), index))
+    for index in order:
+        rate = f'{rates[index] / 2**20:.1f} MB/s' if rates[index] is not None else 'failed'
+        print(f'Endpoint {endpoints[index][0]}: {rate}')
+    return [endpoints[index] for index in order]
+
+
+def download_mirrored(url, headers, fh, connections=1, chunks=None, resume=False, verified=None, mirrors=()):
+    """
+    Download into fh from the best of the mirror links and Apple endpoints, ranked by a
+    short throughput probe. Peer data is checked against the signed chunklist as it
+    arrives like any other download, so mirrors are only used when chunks is given. An
+    endpoint that fails or serves a bad chunk is abandoned, and the next one resumes
+    after the chunks verified so far.
+    """
+    mirrors = list(mirrors) if chunks is not None else []
+    endpoints = image_endpoints(url, headers, mirrors)
+    if len(endpoints) > 1 and chunks is not None and chunks.total_size > PROBE_SIZE * len(endpoints):
+        endpoints = rank_endpoints(endpoints, len(mirrors))
+    links = set(mirrors)
+
+    for index, (link, linkheaders) in enumerate(endpoints):
+        try:
+            download_into(link, linkheaders, fh, connections, chunks, resume, verified, endpoints[index + 1:])
+            if link in links:
+                METRICS.add('mirror_hits')
+            return
+        except (RecoveryError, OSError, http.client.HTTPException) as err:
+            if index + 1 == len(endpoints):
+                raise
+            PROGRESS.flush()
+            print(f'\rWARN: {link} failed ({verification_error(err)}), trying the next source')
+            if link in links:
+                METRICS.add('mirror_failures')
+            resume, verified = chunks is not None, None
+
+
+def save_image(url, sess, filename='', directory='', connections=1, chunks=None, resume=False, force=False, mirrors=()):
+    """
+    Download url into directory, see download_into for chunk verification and resume.
+    Unless force is set, resume trusts the chunks recorded in the verification stamp.
+    Mirror links are tried first, see download_mirrored.
+    """
+    headers, path = prepare_download(url, sess, filename, directory)
+    resume = resume and chunks is not None and os.path.exists(path)
+    verified = load_stamp(path, chunks) if resume and not force else None
+
+    print(f'Saving {url} to {path}...')
+
+    # Opened for reading too, so a failed mirror's verified chunks can be kept.
+    with open(path, 'r+b' if resume else 'w+b') as fh:
+        download_mirrored(url, headers, fh, connections, chunks, resume, verified, mirrors)
+
+    return path
+
+
+def verify_image(dmgpath, cnkpath, jobs=1, force=False):
+    """
+    Verify dmgpath against the chunklist. The image is memory mapped and chunks are
+    hashed on a thread pool (hashlib releases the GIL), with the first failing chunk
+    always reported regardless of completion order. Chunks that pass are recorded in a
+    stamp next to the image, so an unchanged image is not hashed again unless force
+    is set.
+    """
+    with METRICS.phase('verification', image=dmgpath) as phase:
+        print('Verifying image with chunklist...')
+
+        chunks = verify_chunklist(cnkpath)
+        state = file_state(dmgpath)
+        bitmap = bytearray(-(-len(chunks) // 8)) if force else load_stamp(dmgpath, chunks)
+        pending = [index for index in range(len(chunks)) if not is_verified(bitmap, index)]
+        phase.update(chunks=len(chunks), pending=len(pending))
+
+        if len(pending) == 0:
+            print('Image verification complete! (unchanged since the last verification)')
+            return
+
+        with open(dmgpath, 'rb') as dmgf:
+            filesize = os.fstat(dmgf.fileno()).st_size
+            if filesize == 0:
+                raise VerificationError(f'Invalid chunk 1 size: expected {chunks.sizes[0]}, read 0')
+            with mmap.mmap(dmgf.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    def check(index):
+                        cnk = view[chunks.offsets[index]:chunks.offsets[index + 1]]
+                        try:
+                            chunks.check(index, cnk)
+                            METRICS.add('hashed_bytes', len(cnk))
+                        finally:
+                            cnk.release()
+
+                    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+                    try:
+                        futures = [executor.submit(check, index) for index in pending]
+                        for index, future in zip(pending, futures):
+                            # Results are collected in order, so the first failing chunk is raised.
+                            future.result()
+                            mark_verified(bitmap, index)
+                            PROGRESS.status(f'Chunk {index + 1} ({chunks.sizes[index]} bytes)')
+                    finally:
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        # Keep the progress of a failed run too, so the next one only hashes the rest.
+                        save_stamp(dmgpath, chunks, bitmap, state)
+                finally:
+                    view.release()
+            if filesize > chunks.total_size:
+                raise VerificationError('Invalid image: larger than chunklist')
+            PROGRESS.flush()
+            print('\nImage verification complete!')
+
+
+def verification_error(err):
+    # Bare chunklist assertions carry no message, so show the failing check instead.
+    if isinstance(err, AssertionError) and str(err) == '':
+        try:
+            tb = sys.exc_info()[2]
+            while tb.tb_next:
+                tb = tb.tb_next
+            return linecache.getline(tb.tb_frame.f_code.co_filename, tb.tb_lineno, tb.tb_frame.f_globals).strip()
+        except Exception:
+            return 'Invalid chunklist'
+    return err
+
+
+def action_verify_only(args):
+    """
+    Verify previously downloaded images in the output directory without any network access.
+    """
+    if args.basename != '':
+        names = [args.basename]
+    elif os.path.isdir(args.outdir):
+        names = sorted(os.path.splitext(name)[0] for name in os.listdir(args.outdir) if name.endswith('.chunklist'))
+    else:
+        names = []
+
+    if len(names) == 0:
+        print(f'ERROR: No chunklists found in {args.outdir}')
+        return 1
+
+    result = 0
+    for name in names:
+        dmgpath = os.path.join(args.outdir, name + '.dmg')
+        cnkpath = os.path.join(args.outdir, name + '.chunklist')
+        print(f'Checking {dmgpath}...')
+        try:
+            verify_image(dmgpath, cnkpath, args.jobs, args.force)
+        except Exception as err:
+            print(f'\rImage verification failed. ({verification_error(err)})')
+            result = 1
+    return result
+
+
+def materialize(src, dst):
+    """
+    Place a copy of src at dst, preferring a hardlink, then a reflink, then a full copy.
+    A FileRegion dst always gets a full copy.
+    """
+    if isinstance(dst, FileRegion):
+        with open(src, 'rb') as srcf:
+            offset = 0
+            while True:
+                data = srcf.read(2**20)
+                if not data:
+                    break
+                write_at(dst, data, offset)
+                offset += len(data)
+        return 'copy'
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, 'rb') as srcf, open(dst, 'wb') as dstf:
+            fcntl.ioctl(dstf.fileno(), FICLONE, srcf.fileno())
+        return 'reflink'
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+class ImageStore:
+    """
+    Local store of verified recovery images, addressed by product and chunklist digest.
+    Each entry holds image.dmg, image.chunklist and entry.json, whose mtime records the
+    last use for LRU eviction once the store exceeds its byte budget.
+    """
+
+    def __init__(self, directory, budget=STORE_SIZE):
+        self.directory = directory
+        self.budget = budget
+
+    def entry_path(self, product, cnkpath):
+        with open(cnkpath, 'rb') as fh:
+            digest = hashlib.sha256(fh.read()).hexdigest()
+        return os.path.join(self.directory, product, digest)
+
+    def entries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for product in sorted(os.listdir(self.directory)):
+            productdir = os.path.join(self.directory, product)
+            if not os.path.isdir(productdir):
+                continue
+            for digest in sorted(os.listdir(productdir)):
+                path = os.path.join(productdir, digest)
+                try:
+                    with open(os.path.join(path, 'entry.json'), 'r', encoding='utf-8') as fh:
+                        entry = json.load(fh)
+                    entry['path'] = path
+                    entry['digest'] = digest
+                    entry['used'] = os.stat(os.path.join(path, 'entry.json')).st_mtime
+                    entry['size'] = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+                except (OSError, ValueError):
+                    continue
+                entries.append(entry)
+        return entries
+
+    def fetch(self, product, cnkpath, dmgpath, jobs=1, force=False):
+        """
+        Materialize a stored image matching the downloaded chunklist at dmgpath.
+        """
+        path = self.entry_path(product, cnkpath)
+        if not os.path.exists(os.path.join(path, 'entry.json')):
+            return False
+        print(f'Found {product} in image store...')
+        try:
+            verify_image(os.path.join(path, 'image.dmg'), os.path.join(path, 'image.chunklist'), jobs, force)
+        except Exception as err:
+            print(f'\rStored image verification failed, discarding it. ({verification_error(err)})')
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+        os.utime(os.path.join(path, 'entry.json'))
+        method = materialize(os.path.join(path, 'image.dmg'), dmgpath)
+        print(f'Placed stored image at {dmgpath} ({method})')
+        return True
+
+    def add(self, product, cnkpath, dmgpath):
+        path = self.entry_path(product, cnkpath)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Entries are assembled aside and renamed into place so readers never see partial ones.
+        tmppath = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            materialize(dmgpath, os.path.join(tmppath, 'image.dmg'))
+            materialize(cnkpath, os.path.join(tmppath, 'image.chunklist'))
+            with open(os.path.join(tmppath, 'entry.json'), 'w', encoding='utf-8') as fh:
+                json.dump({
+                    'product': product,
+                    'image': os.path.basename(dmgpath),
+                    'chunklist': os.path.basename(cnkpath),
+                    'added': time.time(),
+                }, fh)
+            os.rename(tmppath, path)
+        except OSError:
+            shutil.rmtree(tmppath, ignore_errors=True)
+            if not os.path.exists(path):
+                raise
+        self.prune(keep=path)
+
+    def chunk_index(self):
+        """
+        Map the hash of every chunk in the store to the image path and offset holding it.
+        """
+        index = {}
+        for entry in self.entries():
+            try:
+                chunks = verify_chunklist(os.path.join(entry['path'], 'image.chunklist'))
+            except Exception:
+                continue
+            dmgpath = os.path.join(entry['path'], 'image.dmg')
+            for cnkindex, (_, cnkhash) in enumerate(chunks):
+                index.setdefault(cnkhash, (dmgpath, chunks.offsets[cnkindex]))
+        return index
+
+    def prune(self, keep=None):
+        """
+        Evict least recently used entries until the store fits its budget.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry['used'])
+        total = sum(entry['size'] for entry in entries)
+        removed = []
+        for entry in entries:
+            if total <= self.budget:
+                break
+            if entry['path'] == keep:
+                continue
+            shutil.rmtree(entry['path'], ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(entry['path']))
+            except OSError:
+                pass
+            total -= entry['size']
+            removed.append(entry)
+        return removed
+
+
+def action_store(args):
+    """
+    List or prune the local recovery image store.
+    """
+    store = ImageStore(os.path.join(args.cache_dir, 'images'), args.store_size)
+
+    if args.store_command == 'prune':
+        for entry in store.prune():
+            print(f'Removed {entry["product"]} {entry["digest"][:16]} ({entry["size"] / (2**20):.1f} MB)')
+
+    entries = store.entries()
+    for entry in sorted(entries, key=lambda entry: entry['used'], reverse=True):
+        used = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['used']))
+        print(f'{entry["product"]} {entry["digest"][:16]} {entry["image"]} {entry["size"] / (2**20):.1f} MB, last used {used}')
+    total = sum(entry['size'] for entry in entries)
+    print(f'{len(entries)} images, {total / (2**20):.1f} of {store.budget / (2**20):.1f} MB used')
+    return 0
+
+
+def parse_byte_range(value, size):
+    """
+    Parse a single range Range header for a file of size bytes into (start, end). Returns
+    None for headers that should be ignored, such as several ranges, and a start of at
+    least size when the range cannot be satisfied.
+    """
+    unit, _, spec = value.partition('=')
+    first, dash, last = spec.strip().partition('-')
+    if unit.strip().lower() != 'bytes' or ',' in spec or not dash:
+        return None
+    try:
+        if first == '':
+            count = int(last)
+            return (size - min(count, size), size) if count > 0 else (size, size)
+        start = int(first)
+        end = int(last) + 1 if last != '' else max(size, start + 1)
+    except ValueError:
+        return None
+    if end <= start:
+        return None
+    return start, min(end, size)
+
+
+class PeerRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the image store and cached image info to peers using --mirror. Images are
+    addressed like the store, /images/<product>/<chunklist sha256>/image.dmg, so an
+    entity never changes and its ETag is derived from the address. Range, If-Range,
+    If-None-Match and If-Modified-Since are supported.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'macrecovery'
+
+    def __init__(self, *args, store=None, info_cache=None, verbose=False, **kwargs):
+        self.store = store
+        self.info_cache = info_cache
+        self.verbose = verbose
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.handle_get(head=False)
+
+    def do_HEAD(self):
+        self.handle_get(head=True)
+
+    def send_status(self, status, headers=None, body=b'', head=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def handle_get(self, head):
+        purl = urlparse(self.path)
+        if purl.path == '/info':
+            return self.send_info(parse_qs(purl.query), head)
+        parts = purl.path.split('/')
+        if len(parts) != 5 or parts[:2] != ['', 'images'] or parts[2] in ('', '.', '..') or parts[4] not in PEER_FILES \
+                or len(parts[3]) != 64 or any(char not in string.hexdigits for char in parts[3]):
+            return self.send_status(404, head=head)
+        self.send_file(parts[2], parts[3], parts[4], head)
+
+    def send_info(self, query, head):
+        def field(name, default=''):
+            return query.get(name, [default])[0]
+
+        info = None
+        if self.info_cache is not None:
+            info = self.info_cache.get(field('bid'), field('mlb', MLB_ZERO), field('os', 'default'), field('diag') == '1')
+        if info is None:
+            return self.send_status(404, head=head)
+        self.send_status(200, {'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}, json.dumps(info).encode(), head)
+
+    def not_modified(self, etag, mtime):
+        match = self.headers.get('If-None-Match')
+        if match is not None:
+            # Weak comparison, as required for If-None-Match.
+            return any(tag.strip() in ('*', etag, 'W/' + etag) for tag in match.split(','))
+        since = self.headers.get('If-Modified-Since')
+        if since is not None:
+            try:
+                return int(mtime) <= email.utils.parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def range_applies(self, etag, mtime):
+        condition = self.headers.get('If-Range')
+        if condition is None:
+            return True
+        if condition.startswith(('"', 'W/')):
+            return condition == etag
+        try:
+            return int(mtime) == email.utils.parsedate_to_datetime(condition).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    def send_file(self, product, digest, name, head):
+        entry = os.path.join(self.store.directory, product, digest)
+        try:
+            fh = open(os.path.join(entry, name), 'rb')
+        except OSError:
+            return self.send_status(404, head=head)
+        with fh:
+            stat = os.fstat(fh.fileno())
+            size = stat.st_size
+            etag = f'"{digest}-{name}"'
+            headers = {
+                'ETag': etag,
+                'Last-Modified': email.utils.formatdate(stat.st_mtime, usegmt=True),
+                'Accept-Ranges': 'bytes',
+            }
+            if self.not_modified(etag, stat.st_mtime):
+                return self.send_status(304, headers, head=True)
+
+            start, end, status = 0, size, 200
+            crange = self.headers.get('Range')
+            if crange is not None and self.range_applies(etag, stat.st_mtime):
+                byterange = parse_byte_range(crange, size)
+                if byterange is not None and byterange[0] >= size:
+                    return self.send_status(416, dict(headers, **{'Content-Range': f'bytes */{size}'}), head=head)
+                if byterange is not None:
+                    start, end = byterange
+                    status = 206
+                    headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+
+            self.send_response(status)
+            for header, value in headers.items():
+                self.send_header(header, value)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start))
+            self.end_headers()
+            if not head and end > start:
+                self.connection.sendfile(fh, start, end - start)
+        if name == 'image.dmg':
+            # Serving an image counts as a use for LRU eviction.
+            try:
+                os.utime(os.path.join(entry, 'entry.json'))
+            except OSError:
+                pass
+
+
+class PeerServer(http.server.ThreadingHTTPServer):
+    """
+    Threaded server for PeerRequestHandler that stays quiet when peers hang up, as they
+    do whenever a segment is aborted or fails over to another endpoint.
+    """
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def action_serve(args):
+    """
+    Serve the local image store and cached image info over HTTP, so other nodes can use
+    this one with --mirror instead of downloading from Apple.
+    """
+    store = ImageStore(os.path.join(args.cache_dir, 'images'), args.store_size)
+    handler = functools.partial(PeerRequestHandler, store=store, info_cache=INFO_CACHE, verbose=args.verbose)
+    try:
+        server = PeerServer((args.bind, args.port), handler)
+    except OSError as err:
+        print(f'ERROR: Cannot listen on {args.bind}:{args.port}: {err}')
+        return 1
+    print(f'Serving {len(store.entries())} images from {store.directory} on http://{args.bind}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def download_product(info, directory, basename='', connections=1, jobs=1, resume=False, force=False, store=None, mirrors=()):
+    """
+    Download and verify the chunklist and image described by info into directory,
+    returning their paths. Images are taken from and added to the ImageStore store
+    when one is given, and fetched from peers serving their store before Apple.
+    """
+    cnkname = '' if basename == '' else basename + '.chunklist'
+    with METRICS.phase('chunklist', product=info[INFO_PRODUCT]):
+        cnkpath = save_image(info[INFO_SIGN_LINK], info[INFO_SIGN_SESS], cnkname, directory)
+    dmgname = '' if basename == '' else basename + '.dmg'
+    dmgpath = os.path.join(directory, dmgname or os.path.basename(urlparse(info[INFO_IMAGE_LINK]).path))
+
+    # Chunks are verified while the image streams in, so no second pass is needed.
+    chunks = verify_chunklist(cnkpath)
+    index = {}
+    with METRICS.phase('image', product=info[INFO_PRODUCT], size=chunks.total_size) as phase:
+        if store is not None:
+            if store.fetch(info[INFO_PRODUCT], cnkpath, dmgpath, jobs, force):
+                phase['method'] = 'store'
+                save_stamp(dmgpath, chunks)
+                return cnkpath, dmgpath
+            if not (resume and os.path.exists(dmgpath)):
+                index = store.chunk_index()
+        if mirrors:
+            phase['method'] = 'mirror'
+            save_image(info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS], dmgname, directory, connections, chunks, resume, force,
+                       mirror_links(mirrors, info[INFO_PRODUCT], chunks.hexdigest))
+        elif any(cnkhash in index for _, cnkhash in chunks):
+            phase['method'] = 'delta'
+            save_image_delta(info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS], dmgname, directory, chunks, index, connections)
+        else:
+            phase['method'] = 'download'
+            save_image(info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS], dmgname, directory, connections, chunks, resume, force)
+    print('Image verification complete!')
+    save_stamp(dmgpath, chunks)
+    if store is not None:
+        store.add(info[INFO_PRODUCT], cnkpath, dmgpath)
+    return cnkpath, dmgpath
+
+
+def build_recovery_image(info, path, size='', label='RECOVERY', outdir='com.apple.recovery.boot', basename='',
+                         connections=1, jobs=1, resume=False, force=False, store=None, mirrors=()):
+    """
+    Build a FAT32 image at path holding the chunklist and image under outdir. The image
+    is streamed straight into its preallocated clusters, so no mounting or privileges
+    are needed and several images can be built at once. size takes fallocate style
+    sizes and defaults to fit the download.
+    """
+    # Only image builds need fat32.py, so macrecovery.py keeps working when copied alone.
+    try:
+        import fat32
+    except ImportError:
+        raise RecoveryError('Building FAT32 images needs fat32.py next to macrecovery.py') from None
+
+    cnkname = os.path.basename(urlparse(info[INFO_SIGN_LINK]).path) if basename == '' else basename + '.chunklist'
+    dmgname = os.path.basename(urlparse(info[INFO_IMAGE_LINK]).path) if basename == '' else basename + '.dmg'
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with METRICS.phase('chunklist', product=info[INFO_PRODUCT]):
+            cnkpath = save_image(info[INFO_SIGN_LINK], info[INFO_SIGN_SESS], cnkname, tmpdir)
+        chunks = verify_chunklist(cnkpath)
+        cnksize = os.path.getsize(cnkpath)
+        dmgsize = chunks.total_size
+
+        if size != '':
+            size = fat32.parse_size(size)
+        else:
+            # Leave room for file system metadata and cluster slack.
+            size = -(-max(64 * 2**20, (cnksize + dmgsize) * 17 // 16 + 16 * 2**20) // 2**20) * 2**20
+        image = fat32.Fat32Image(size, label)
+        cnknode = image.add_file(f'{outdir}/{cnkname}', cnksize)
+        dmgnode = image.add_file(f'{outdir}/{dmgname}', dmgsize)
+        image.allocate()
+
+        resume = resume and os.path.exists(path)
+        with open(path, 'r+b' if resume else 'w+b') as fh:
+            image.write(fh)
+            with open(cnkpath, 'rb') as cnkf:
+                write_at(fh, cnkf.read(), cnknode.offset)
+            region = FileRegion(fh, dmgnode.offset, dmgnode.size)
+            with METRICS.phase('image', product=info[INFO_PRODUCT], size=dmgsize, method='store') as phase:
+                if store is None or not store.fetch(info[INFO_PRODUCT], cnkpath, region, jobs, force):
+                    phase['method'] = 'download'
+                    print(f'Saving {info[INFO_IMAGE_LINK]} to {path}...')
+                    headers = asset_headers(info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS])
+                    download_mirrored(info[INFO_IMAGE_LINK], headers, region, connections, chunks, resume,
+                                      mirrors=mirror_links(mirrors, info[INFO_PRODUCT], chunks.hexdigest))
+                    print('Image verification complete!')
+
+    print(f'Created {path} ({size / (2**20):.0f} MB FAT32)')
+    return path
+
+
+class RecoveryClient:
+    """
+    Asyncio interface for embedding macrecovery in other tools. Blocking transfers and
+    hashing run on the client's thread pool, so one event loop can drive many jobs that
+    share a session cookie and the module connection pool. Failures raise RecoveryError
+    subclasses instead of exiting.
+    """
+
+    def __init__(self, connections=1, jobs=1, resume=False, force=False, store=None, mirrors=(), workers=32, verbose=False):
+        self.connections = connections
+        self.jobs = jobs
+        self.resume = resume
+        self.force = force
+        self.store = store
+        self.mirrors = list(mirrors)
+        self.verbose = verbose
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.cookie = None
+        self.cookie_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    async def call(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def session(self, refresh=False):
+        """
+        Return the session cookie, requesting it once and sharing it between all calls.
+        """
+        if self.cookie_lock is None:
+            self.cookie_lock = asyncio.Lock()
+        async with self.cookie_lock:
+            if self.cookie is None or refresh:
+                self.cookie = await self.call(get_session, self.verbose)
+            return self.cookie
+
+    async def image_info(self, board_id=RECENT_MAC, mlb=MLB_ZERO, os_type='default', diagnostics=False, cached=True):
+        session = await self.session()
+        return await self.call(get_image_info, session, bid=board_id, mlb=mlb, diag=diagnostics, os_type=os_type,
+                               cached=cached, mirrors=self.mirrors)
+
+    async def download(self, info, directory, basename=''):
+        """
+        Download and verify the image described by info, returning (chunklist, image) paths.
+        """
+        return await self.call(download_product, info, directory, basename, self.connections, self.jobs,
+                               self.resume, self.force, self.store, self.mirrors)
+
+    async def build_image(self, info, path, size='', label='RECOVERY', outdir='com.apple.recovery.boot', basename=''):
+        """
+        Build a FAT32 recovery disk image at path, see build_recovery_image.
+        """
+        return await self.call(build_recovery_image, info, path, size, label, outdir, basename, self.connections,
+                               self.jobs, self.resume, self.force, self.store, self.mirrors)
+
+    async def verify(self, dmgpath, cnkpath):
+        await self.call(verify_image, dmgpath, cnkpath, self.jobs, self.force)
+
+
+def run_client(args, func, workers=32):
+    """
+    Run the coroutine function func with a RecoveryClient configured from args.
+    """
+    store = ImageStore(os.path.join(args.cache_dir, 'images'), args.store_size) if args.store else None
+
+    async def runner():
+        async with RecoveryClient(connections=args.connections, jobs=args.jobs, resume=args.resume, force=args.force,
+                                  store=store, mirrors=args.mirror, workers=workers, verbose=args.verbose) as client:
+            return await func(client)
+
+    return asyncio.run(runner())
 
 
 def action_download(args):
@@ -291,29 +2097,121 @@ def action_download(args):
     fg=B2E6AA07DB9088BE5BDB38DB2EA824FDDFB6C3AC5272203B32D89F9D8E3528DC
     """
 
-    session = get_session(args)
-    info = get_image_info(session, bid=args.board_id, mlb=args.mlb, diag=args.diagnostics, os_type=args.os_type)
-    if args.verbose:
-        print(info)
-    print(f'Downloading {info[INFO_PRODUCT]}...')
-    cnkname = '' if args.basename == '' else args.basename + '.chunklist'
-    cnkpath = save_image(info[INFO_SIGN_LINK], info[INFO_SIGN_SESS], cnkname, args.outdir)
-    dmgname = '' if args.basename == '' else args.basename + '.dmg'
-    dmgpath = save_image(info[INFO_IMAGE_LINK], info[INFO_IMAGE_SESS], dmgname, args.outdir)
-    try:
-        verify_image(dmgpath, cnkpath)
-        return 0
-    except Exception as err:
-        if isinstance(err, AssertionError) and str(err) == '':
-            try:
-                tb = sys.exc_info()[2]
-                while tb.tb_next:
-                    tb = tb.tb_next
-                err = linecache.getline(tb.tb_frame.f_code.co_filename, tb.tb_lineno, tb.tb_frame.f_globals).strip()
-            except Exception:
-                err = "Invalid chunklist"
-        print(f'\rImage verification failed. ({err})')
+    if args.verify_only:
+        return action_verify_only(args)
+
+    async def download(client):
+        # Image links carry short-lived asset tokens, so downloads always ask for fresh info.
+        info = await client.image_info(args.board_id, args.mlb, args.os_type, args.diagnostics, cached=False)
+        if args.verbose:
+            print(info)
+        print(f'Downloading {info[INFO_PRODUCT]}...')
+        try:
+            if args.image != '':
+                await client.build_image(info, args.image, args.image_size, args.image_label, args.outdir, args.basename)
+            else:
+                await client.download(info, args.outdir, args.basename)
+            return 0
+        except VerificationError as err:
+            print(f'\rImage verification failed. ({verification_error(err)})')
+            return 1
+
+    return run_client(args, download)
+
+
+def read_manifest(path, os_type='default'):
+    """
+    Read (board_id, mlb, os_type) entries from a boards.json style board list or from
+    recovery_urls.txt style macrecovery invocations.
+    """
+    entries = []
+    if path.endswith('.json'):
+        with open(path, 'r', encoding='utf-8') as fh:
+            for bid in json.load(fh):
+                entries.append((bid, MLB_ZERO, os_type))
+    else:
+        with open(path, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    tokens = shlex.split(line)
+                except ValueError:
+                    continue
+                options = {}
+                for option, value in zip(tokens, tokens[1:]):
+                    if option in ('-b', '--board-id', '-m', '--mlb', '-os', '--os-type'):
+                        options[option.lstrip('-')[0]] = value
+                # Skip diagnostics and placeholder MLB examples.
+                if 'b' not in options or '-diag' in tokens or '--diagnostics' in tokens:
+                    continue
+                if len(options.get('m', MLB_ZERO)) == 17:
+                    entries.append((options['b'], options.get('m', MLB_ZERO), options.get('o', os_type)))
+    return list(dict.fromkeys(entries))
+
+
+def action_mirror(args):
+    """
+    Download every distinct product referenced by a manifest into per-product directories
+    and write a machine-readable index of the results. Entries that fail to resolve are
+    listed in the index with their error and fail the run like failed downloads.
+    """
+    global SHOW_PROGRESS
+
+    entries = read_manifest(args.manifest, args.os_type)
+    products = {}
+    unresolved = []
+
+    async def fetch(client, name):
+        record = {'product': name, 'sources': products[name]['sources'], 'verified': False}
+        try:
+            cnkpath, dmgpath = await client.download(products[name]['info'], os.path.join(args.outdir, name))
+            with open(cnkpath, 'rb') as fh:
+                cnkdigest = hashlib.sha256(fh.read()).hexdigest()
+            record.update({
+                'image': os.path.relpath(dmgpath, args.outdir),
+                'chunklist': os.path.relpath(cnkpath, args.outdir),
+                'size': os.path.getsize(dmgpath),
+                'chunklist_sha256': cnkdigest,
+                'verified': True,
+            })
+            print(f'Mirrored {name}')
+        except Exception as err:
+            record['error'] = str(verification_error(err))
+            print(f'WARN: Failed to mirror {name} ({record["error"]})')
+        return record
+
+    async def mirror(client):
+        infos = await asyncio.gather(*(client.image_info(bid, mlb, os_type, args.diagnostics, cached=False)
+                                       for bid, mlb, os_type in entries), return_exceptions=True)
+        for (bid, mlb, os_type), info in zip(entries, infos):
+            if isinstance(info, Exception):
+                print(f'WARN: Failed to resolve {bid} with MLB {mlb}, exception: {info}')
+                unresolved.append({'board_id': bid, 'mlb': mlb, 'os_type': os_type, 'error': str(info)})
+                continue
+            product = products.setdefault(info[INFO_PRODUCT], {'info': info, 'sources': []})
+            product['sources'].append({'board_id': bid, 'mlb': mlb, 'os_type': os_type})
+
+        print(f'Resolved {len(entries)} entries to {len(products)} products')
+        return await asyncio.gather(*(fetch(client, name) for name in products))
+
+    SHOW_PROGRESS = args.parallel == 1
+    records = run_client(args, mirror, workers=args.parallel)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=args.outdir, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+        json.dump({'generated': time.time(), 'manifest': os.path.abspath(args.manifest), 'products': records,
+                   'unresolved': unresolved}, fh, indent=1)
+    os.replace(tmppath, os.path.join(args.outdir, 'index.json'))
+
+    failed = [record['product'] for record in records if not record['verified']]
+    if failed:
+        print(f'ERROR: Failed to mirror {", ".join(failed)}')
+    if unresolved:
+        print(f'ERROR: Failed to resolve {len(unresolved)} of {len(entries)} manifest entries')
+    if failed or unresolved:
         return 1
+    print(f'SUCCESS: Mirrored {len(records)} products to {args.outdir}')
+    return 0
 
 
 def action_selfcheck(args):
@@ -333,13 +2231,16 @@ def action_selfcheck(args):
     return default_recovery(ppp = ppp)              # Returns oldest.
     """
 
-    session = get_session(args)
-    valid_default = get_image_info(session, bid=RECENT_MAC, mlb=MLB_VALID, diag=False, os_type='default')
-    valid_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_VALID, diag=False, os_type='latest')
-    product_default = get_image_info(session, bid=RECENT_MAC, mlb=MLB_PRODUCT, diag=False, os_type='default')
-    product_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_PRODUCT, diag=False, os_type='latest')
-    generic_default = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='default')
-    generic_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
+    async def query(client):
+        return await asyncio.gather(
+            client.image_info(RECENT_MAC, MLB_VALID, 'default'),
+            client.image_info(RECENT_MAC, MLB_VALID, 'latest'),
+            client.image_info(RECENT_MAC, MLB_PRODUCT, 'default'),
+            client.image_info(RECENT_MAC, MLB_PRODUCT, 'latest'),
+            client.image_info(RECENT_MAC, MLB_ZERO, 'default'),
+            client.image_info(RECENT_MAC, MLB_ZERO, 'latest'))
+
+    valid_default, valid_latest, product_default, product_latest, generic_default, generic_latest = run_client(args, query)
 
     if args.verbose:
         print(valid_default)
@@ -383,11 +2284,14 @@ def action_verify(args):
     """
     Try to verify MLB serial number.
     """
-    session = get_session(args)
-    generic_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
-    uvalid_default = get_image_info(session, bid=args.board_id, mlb=args.mlb, diag=False, os_type='default')
-    uvalid_latest = get_image_info(session, bid=args.board_id, mlb=args.mlb, diag=False, os_type='latest')
-    uproduct_default = get_image_info(session, bid=args.board_id, mlb=product_mlb(args.mlb), diag=False, os_type='default')
+    async def query(client):
+        return await asyncio.gather(
+            client.image_info(RECENT_MAC, MLB_ZERO, 'latest'),
+            client.image_info(args.board_id, args.mlb, 'default'),
+            client.image_info(args.board_id, args.mlb, 'latest'),
+            client.image_info(args.board_id, product_mlb(args.mlb), 'default'))
+
+    generic_latest, uvalid_default, uvalid_latest, uproduct_default = run_client(args, query)
 
     if args.verbose:
         print(generic_latest)
@@ -414,6 +2318,69 @@ def action_verify(args):
     return 0
 
 
+async def board_latest(client, model, generic_latest):
+    return generic_latest if model == RECENT_MAC else await client.image_info(model, MLB_ZERO, 'latest')
+
+
+async def probe_model(client, model, version, mlb, anon, generic_latest, model_latest=None):
+    """
+    Check a single board for MLB support, returning the supported entry (or None)
+    and any warnings to print. Anonymous lookups use model_latest when it is known.
+    """
+    try:
+        if anon:
+            # For anonymous lookup check when given model does not match latest.
+            if model_latest is None:
+                model_latest = await board_latest(client, model, generic_latest)
+
+            if model_latest[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
+                if version == 'current':
+                    return None, [f'WARN: Skipped {model} due to using latest product {model_latest[INFO_PRODUCT]} instead of {generic_latest[INFO_PRODUCT]}']
+                return None, []
+
+            user_default = await client.image_info(model, mlb, 'default')
+
+            if user_default[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
+                return [version, user_default[INFO_PRODUCT], generic_latest[INFO_PRODUCT]], []
+        else:
+            # For normal lookup check when given model has mismatching normal and latest.
+            user_latest = await client.image_info(model, mlb, 'latest')
+
+            user_default = await client.image_info(model, mlb, 'default')
+
+            if user_latest[INFO_PRODUCT] != user_default[INFO_PRODUCT]:
+                return [version, user_default[INFO_PRODUCT], user_latest[INFO_PRODUCT]], []
+
+    except Exception as e:
+        return None, [f'WARN: Failed to check {model}, exception: {e}']
+
+    return None, []
+
+
+async def probe_tier(client, models, version, mlb, anon, generic_latest, exhaustive=False):
+    """
+    Probe the boards of one boards.json version tier, returning a (result, warnings) pair
+    per board. MLB answers depend on the board, so every board is asked for them. Only
+    the latest product of anonymous lookups is shared by boards with one maximum version:
+    once GUESS_REPRESENTATIVES boards agree on it, the other boards reuse it, and a tier
+    whose latest product is not the generic one is skipped without any MLB queries.
+    Full MLBs have no such per-tier answer, so they always query every board.
+    """
+    known = {}
+    if anon and not exhaustive and version != 'current':
+        representatives = models[:GUESS_REPRESENTATIVES]
+        try:
+            latests = await asyncio.gather(*(board_latest(client, model, generic_latest) for model in representatives))
+        except Exception:
+            latests = []
+        known = dict(zip(representatives, latests))
+        if latests and all(latest[INFO_PRODUCT] == latests[0][INFO_PRODUCT] for latest in latests):
+            if latests[0][INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
+                return [(None, [])] * len(models)
+            known = dict.fromkeys(models, latests[0])
+    return await asyncio.gather(*(probe_model(client, model, version, mlb, anon, generic_latest, known.get(model)) for model in models))
+
+
 def action_guess(args):
     """
     Attempt to guess which model does this MLB belong.
@@ -427,40 +2394,30 @@ def action_guess(args):
 
     supported = {}
 
-    session = get_session(args)
+    tiers = {}
+    for model, version in db.items():
+        tiers.setdefault(version, []).append(model)
 
-    generic_latest = get_image_info(session, bid=RECENT_MAC, mlb=MLB_ZERO, diag=False, os_type='latest')
+    async def probe(client):
+        # Queried once and shared by every tier.
+        generic_latest = await client.image_info(RECENT_MAC, MLB_ZERO, 'latest')
+        return await asyncio.gather(*(probe_tier(client, models, version, mlb, anon, generic_latest, args.exhaustive)
+                                      for version, models in tiers.items()))
 
+    # Tiers are probed concurrently, but results are collected in board order.
+    results = {}
+    for models, probes in zip(tiers.values(), run_client(args, probe, workers=args.parallel)):
+        results.update(zip(models, probes))
     for model in db:
-        try:
-            if anon:
-                # For anonymous lookup check when given model does not match latest.
-                model_latest = get_image_info(session, bid=model, mlb=MLB_ZERO, diag=False, os_type='latest')
-
-                if model_latest[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
-                    if db[model] == 'current':
-                        print(f'WARN: Skipped {model} due to using latest product {model_latest[INFO_PRODUCT]} instead of {generic_latest[INFO_PRODUCT]}')
-                    continue
-
-                user_default = get_image_info(session, bid=model, mlb=mlb, diag=False, os_type='default')
-
-                if user_default[INFO_PRODUCT] != generic_latest[INFO_PRODUCT]:
-                    supported[model] = [db[model], user_default[INFO_PRODUCT], generic_latest[INFO_PRODUCT]]
-            else:
-                # For normal lookup check when given model has mismatching normal and latest.
-                user_latest = get_image_info(session, bid=model, mlb=mlb, diag=False, os_type='latest')
-
-                user_default = get_image_info(session, bid=model, mlb=mlb, diag=False, os_type='default')
-
-                if user_latest[INFO_PRODUCT] != user_default[INFO_PRODUCT]:
-                    supported[model] = [db[model], user_default[INFO_PRODUCT], user_latest[INFO_PRODUCT]]
-
-        except Exception as e:
-            print(f'WARN: Failed to check {model}, exception: {e}')
+        result, warnings = results[model]
+        for warning in warnings:
+            print(warning)
+        if result is not None:
+            supported[model] = result
 
     if len(supported) > 0:
         print(f'SUCCESS: MLB {mlb} looks supported for:')
-        for model in supported.items():
+        for model in supported:
             print(f'- {model}, up to {supported[model][0]}, default: {supported[model][1]}, latest: {supported[model][2]}')
         return 0
 
@@ -469,11 +2426,17 @@ def action_guess(args):
 
 
 def main():
+    global INFO_CACHE, METRICS, RATE_LIMITER, RETRY_POLICY, SHOW_PROGRESS
+
     parser = argparse.ArgumentParser(description='Gather recovery information for Macs')
-    parser.add_argument('action', choices=['download', 'selfcheck', 'verify', 'guess'],
+    parser.add_argument('action', choices=['download', 'selfcheck', 'verify', 'guess', 'store', 'mirror', 'serve'],
                         help='Action to perform: "download" - performs recovery downloading,'
                         ' "selfcheck" checks whether MLB serial validation is possible, "verify" performs'
-                        ' MLB serial verification, "guess" tries to find suitable mac model for MLB.')
+                        ' MLB serial verification, "guess" tries to find suitable mac model for MLB,'
+                        ' "store" lists or prunes the local image store, "mirror" downloads every product in a manifest,'
+                        ' "serve" shares the image store and cached image info with peers over HTTP.')
+    parser.add_argument('store_command', nargs='?', choices=['list', 'prune'],
+                        help='store action to perform, defaults to list')
     parser.add_argument('-o', '--outdir', type=str, default='com.apple.recovery.boot',
                         help='customise output directory for downloading, defaults to com.apple.recovery.boot')
     parser.add_argument('-n', '--basename', type=str, default='',
@@ -487,29 +2450,147 @@ def main():
     parser.add_argument('-os', '--os-type', type=str, default='default', choices=['default', 'latest'],
                         help=f'use specified os type, defaults to default {MLB_ZERO}')
     parser.add_argument('-diag', '--diagnostics', action='store_true', help='download diagnostics image')
+    parser.add_argument('-c', '--connections', type=int, default=1,
+                        help='download image over the specified number of parallel range requests, defaults to 1')
+    parser.add_argument('--resume', action='store_true',
+                        help='keep verified chunks of a partially downloaded image and fetch only the rest')
+    parser.add_argument('--image', type=str, default='',
+                        help='build a FAT32 disk image at the specified path with the download placed in the output directory')
+    parser.add_argument('--image-size', type=str, default='',
+                        help='use specified disk image size such as 800M, defaults to fit the download')
+    parser.add_argument('--image-label', type=str, default='RECOVERY',
+                        help='use specified disk image volume label, defaults to RECOVERY')
+    parser.add_argument('--force', action='store_true',
+                        help='ignore verification stamps and hash whole images again')
+    parser.add_argument('--metrics-json', type=str, default='',
+                        help='append phase timings and counters as JSON Lines to the specified file, or file descriptor if numeric')
+    parser.add_argument('--verify-only', action='store_true',
+                        help='verify previously downloaded images in the output directory instead of downloading')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='use specified number of threads for image verification, defaults to CPU count')
+    parser.add_argument('-p', '--parallel', type=int, default=4,
+                        help='use specified number of concurrent board queries and mirror downloads, defaults to 4')
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help=f'give up connecting after the specified number of seconds, defaults to {CONNECT_TIMEOUT}')
+    parser.add_argument('--read-timeout', type=float, default=READ_TIMEOUT,
+                        help=f'give up on a connection sending no data for the specified number of seconds, defaults to {READ_TIMEOUT}')
+    parser.add_argument('--retries', type=int, default=RETRIES,
+                        help=f'retry failed requests and transfers the specified number of times, defaults to {RETRIES}')
+    parser.add_argument('--hedge-delay', type=float, default=HEDGE_DELAY,
+                        help=f'repeat metadata queries not answered within the specified number of seconds, 0 disables, defaults to {HEDGE_DELAY}')
+    parser.add_argument('--stall-window', type=float, default=STALL_WINDOW,
+                        help=f'switch away from transfers that crawl for the specified number of seconds, 0 disables, defaults to {STALL_WINDOW}')
+    parser.add_argument('--stall-floor', type=int, default=STALL_FLOOR,
+                        help='also treat connections slower than the specified bytes per second as stalled, defaults to off')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='limit combined download rate to the specified bytes per second, defaults to unlimited')
+    parser.add_argument('--manifest', type=str, default=os.path.join(SELF_DIR, 'recovery_urls.txt'),
+                        help='use boards.json or recovery_urls.txt style manifest for mirroring, defaults to recovery_urls.txt')
+    parser.add_argument('--cache-dir', type=str, default=CACHE_DIR,
+                        help=f'use specified directory for cached image info, defaults to {CACHE_DIR}')
+    parser.add_argument('--cache-ttl', type=int, default=CACHE_TTL,
+                        help=f'reuse cached image info for the specified number of seconds, defaults to {CACHE_TTL}')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help=f'keep at most the specified number of cached image info entries, defaults to {CACHE_SIZE}')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write cached image info')
+    parser.add_argument('--refresh', action='store_true', help='query fresh image info and update the cache')
+    parser.add_argument('--store', action='store_true',
+                        help='reuse verified images from the local image store and add new downloads to it')
+    parser.add_argument('--store-size', type=int, default=STORE_SIZE,
+                        help=f'evict least recently used images once the store exceeds the specified bytes, defaults to {STORE_SIZE}')
+    parser.add_argument('--exhaustive', action='store_true',
+                        help='query the latest product of every board for anonymous guess instead of once per board version')
+    parser.add_argument('--mirror', type=str, action='append', default=[],
+                        help='try the specified peer running serve, such as http://node1:8080, before Apple, may be repeated')
+    parser.add_argument('--bind', type=str, default='0.0.0.0', help='listen on the specified address for serve, defaults to all')
+    parser.add_argument('--port', type=int, default=8080, help='listen on the specified port for serve, defaults to 8080')
     parser.add_argument('-v', '--verbose', action='store_true', help='print debug information')
     parser.add_argument('-db', '--board-db', type=str, default=os.path.join(SELF_DIR, 'boards.json'),
                         help='use custom board list for checking, defaults to boards.json')
 
     args = parser.parse_args()
 
+    if args.store_command is not None and args.action != 'store':
+        print(f'ERROR: {args.store_command} is only valid for the store action!')
+        sys.exit(1)
+
     if args.code != '':
         args.mlb = mlb_from_eeee(args.code)
 
+    if args.connections < 1:
+        print('ERROR: Cannot use less than one connection!')
+        sys.exit(1)
+
+    if args.jobs < 1:
+        print('ERROR: Cannot use less than one verification job!')
+        sys.exit(1)
+
+    if args.parallel < 1:
+        print('ERROR: Cannot use less than one parallel query!')
+        sys.exit(1)
+
+    if args.connect_timeout <= 0 or args.read_timeout <= 0 or args.retries < 0:
+        print('ERROR: Timeouts must be positive and retries cannot be negative!')
+        sys.exit(1)
+
     if len(args.mlb) != 17:
         print('ERROR: Cannot use MLBs in non 17 character format!')
         sys.exit(1)
 
-    if args.action == 'download':
-        return action_download(args)
-    if args.action == 'selfcheck':
-        return action_selfcheck(args)
-    if args.action == 'verify':
-        return action_verify(args)
-    if args.action == 'guess':
-        return action_guess(args)
+    # Globals are always reassigned, so repeated in-process runs (benchmark.py) start clean.
+    SHOW_PROGRESS = True
+    RATE_LIMITER = RateLimiter(args.bandwidth) if args.bandwidth > 0 else None
+    RETRY_POLICY = RetryPolicy(args.connect_timeout, args.read_timeout, args.retries, args.hedge_delay, args.stall_window,
+                               args.stall_floor)
+
+    INFO_CACHE = None
+    if not args.no_cache:
+        INFO_CACHE = InfoCache(os.path.join(args.cache_dir, 'info'), args.cache_ttl, args.cache_size, args.refresh)
 
-    assert False
+    METRICS = Metrics()
+    if args.metrics_json != '':
+        try:
+            if args.metrics_json.isdigit():
+                metricsf = open(int(args.metrics_json), 'a', encoding='utf-8', closefd=False)
+            else:
+                metricsf = open(args.metrics_json, 'a', encoding='utf-8')
+        except OSError as err:
+            print(f'ERROR: Cannot open metrics output {args.metrics_json}: {err}')
+            sys.exit(1)
+        METRICS = Metrics(metricsf, args.action)
+
+    start = time.monotonic()
+    before = METRICS.snapshot()
+    result = 1
+    try:
+        if args.action == 'download':
+            result = action_download(args)
+        elif args.action == 'selfcheck':
+            result = action_selfcheck(args)
+        elif args.action == 'verify':
+            result = action_verify(args)
+        elif args.action == 'guess':
+            result = action_guess(args)
+        elif args.action == 'store':
+            result = action_store(args)
+        elif args.action == 'mirror':
+            result = action_mirror(args)
+        elif args.action == 'serve':
+            result = action_serve(args)
+        else:
+            assert False
+        return result
+    except (RuntimeError, OSError) as err:
+        # Typed RecoveryErrors, fat32 image errors and file system failures alike.
+        print(f'ERROR: {err}')
+        return result
+    finally:
+        if args.verbose:
+            print(f'Opened {POOL.connections} connections for {POOL.requests} requests')
+        POOL.close()
+        METRICS.emit('action', status=result, **METRICS.totals(before, time.monotonic() - start))
+        if METRICS.fh is not None:
+            METRICS.fh.close()
 
 
 if __name__ == '__main__':